@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class CoreConfig(AppConfig):
+    name = 'core'
+    verbose_name = 'Core'
+
+    def ready(self):
+        """
+        Connects the signal handlers that keep core's per-process caches (e.g. the site routing table) up to date.
+        """
+        from .signals import connect_signals
+        connect_signals()
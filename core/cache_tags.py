@@ -0,0 +1,145 @@
+"""
+Tag-based invalidation for cached pages and fragments.
+
+While a response is rendered, the things it depends on (its Site, the Pages it shows, the snippets and settings it
+reads) are recorded as tags on the request. Whenever something is cached along with its tags, each tag's set of cache
+keys in redis gains that key. invalidate_tags() then deletes exactly the keys filed under the given tags, and asks any
+edge caches to purge the responses which carried those tags in their Surrogate-Key header.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from djunk.middleware import get_current_request
+
+from core.logging import logger
+
+CACHE_TAG_KEY_PREFIX = 'cache-tag'
+
+
+def site_tag(site_pk):
+    return 'site-{}'.format(site_pk)
+
+
+def page_tag(page_pk):
+    return 'page-{}'.format(page_pk)
+
+
+def snippet_tag(instance):
+    return 'snippet-{}-{}'.format(instance._meta.label_lower, instance.pk)
+
+
+def settings_tag(model, site_pk):
+    return 'settings-{}-{}'.format(model._meta.label_lower, site_pk)
+
+
+def view_tag(view_data):
+    """
+    Returns a tag for the view recorded by djunk.middleware.BindViewDataToRequestMiddleware.
+    """
+    return 'view-{}-{}'.format(view_data['app_name'] or 'none', view_data['view_name'])
+
+
+def tag_request(*tags, **kwargs):
+    """
+    Records that the response to the given request (or the current request, if none is given) depends on the things
+    represented by the given tags. Does nothing outside of a request.
+    """
+    request = kwargs.get('request') or get_current_request()
+    if request is None:
+        return
+    try:
+        request._cache_tags.update(tags)
+    except AttributeError:
+        request._cache_tags = set(tags)
+
+
+def get_request_tags(request):
+    """
+    Returns every tag recorded on the given request, including the ones implied by its Site and view.
+    """
+    tags = set(getattr(request, '_cache_tags', ()))
+    if getattr(request, 'site', None) is not None:
+        tags.add(site_tag(request.site.pk))
+    view_data = getattr(request, 'view_data', None)
+    if view_data:
+        tags.add(view_tag(view_data))
+    return tags
+
+
+def get_tag_set_key(tag):
+    return cache.make_key('{}:{}'.format(CACHE_TAG_KEY_PREFIX, tag))
+
+
+def get_tag_connection():
+    """
+    Returns the redis connection behind the default cache, or None if it isn't a redis cache (e.g. when DISABLE_CACHE
+    swaps in the DummyCache), in which case there's nothing for tags to track.
+    """
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def register_tagged_key(key, tags, timeout):
+    """
+    Files the given cache key under each of the given tags. Each tag's set lives as long as the longest-lived key that
+    was added to it, so that abandoned sets clean themselves up.
+    """
+    conn = get_tag_connection()
+    if conn is None or not tags:
+        return
+    tag_set_keys = [get_tag_set_key(tag) for tag in tags]
+    pipe = conn.pipeline()
+    for tag_set_key in tag_set_keys:
+        pipe.ttl(tag_set_key)
+        pipe.sadd(tag_set_key, key)
+    ttls = pipe.execute()[::2]
+
+    # Only ever extend a set's lifetime, never shorten it. ttl() is -2 for sets which didn't exist yet, and -1 for sets
+    # which already never expire.
+    pipe = conn.pipeline()
+    for tag_set_key, ttl in zip(tag_set_keys, ttls):
+        if timeout is None:
+            pipe.persist(tag_set_key)
+        elif ttl != -1 and ttl < timeout:
+            pipe.expire(tag_set_key, timeout)
+    pipe.execute()
+
+
+def set_tagged(key, value, tags, timeout=None):
+    """
+    Caches the given value, like cache.set(), and files its key under the given tags.
+    """
+    cache.set(key, value, timeout)
+    register_tagged_key(key, tags, timeout)
+
+
+def invalidate_tags(*tags):
+    """
+    Deletes every cached value filed under any of the given tags, and purges those tags from any edge caches. This
+    happens once the current transaction commits, so that a concurrent request can't re-cache the old content.
+    """
+    # Must import locally to avoid circular import.
+    from core.page_cache import purge_surrogate_keys
+
+    tags = [tag for tag in tags if tag]
+    if not tags:
+        return
+
+    def invalidate():
+        conn = get_tag_connection()
+        if conn is not None:
+            tag_set_keys = [get_tag_set_key(tag) for tag in tags]
+            pipe = conn.pipeline()
+            for tag_set_key in tag_set_keys:
+                pipe.smembers(tag_set_key)
+            pipe.delete(*tag_set_keys)
+            keys = set()
+            for members in pipe.execute()[:-1]:
+                keys.update(member.decode('utf-8') for member in members)
+            if keys:
+                cache.delete_many(keys)
+            logger.debug('cache_tags.invalidated', tags=tags, keys=len(keys))
+        purge_surrogate_keys(tags)
+    transaction.on_commit(invalidate)
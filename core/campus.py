@@ -0,0 +1,92 @@
+"""
+Decides whether a request comes from the campus network, for Documents that are only available on campus.
+
+The CAMPUS_NETWORKS setting is compiled once per process into a CampusNetworkMatcher, which merges the networks into
+sorted, non-overlapping ranges of integer addresses (one list for IPv4 and one for IPv6), so that checking an address
+is a binary search rather than a scan through every network. Each request's answer is memoized on the request, so pages
+and downloads which check many Documents only parse the client's IP once.
+"""
+import ipaddress
+from bisect import bisect_right
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from djunk.utils import get_client_ip
+from six import text_type
+
+
+class CampusNetworkMatcher(object):
+
+    def __init__(self, networks):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            network = ipaddress.ip_network(text_type(network), strict=False)
+            ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+        self.starts = {}
+        self.ends = {}
+        for version, version_ranges in ranges.items():
+            merged = []
+            for start, end in sorted(version_ranges):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+                else:
+                    merged.append((start, end))
+            self.starts[version] = [start for start, end in merged]
+            self.ends[version] = [end for start, end in merged]
+
+    def __contains__(self, ip):
+        """
+        Returns True if the given IP address string is in any of the campus networks. Invalid addresses never are.
+        """
+        try:
+            address = ipaddress.ip_address(text_type(ip).strip())
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped is not None:
+            # e.g. ::ffff:10.1.2.3, from dual-stack proxies.
+            address = address.ipv4_mapped
+        value = int(address)
+        index = bisect_right(self.starts[address.version], value) - 1
+        return index >= 0 and value <= self.ends[address.version][index]
+
+
+_campus_network_matcher = None
+
+
+def get_campus_network_matcher():
+    """
+    Returns the CampusNetworkMatcher for the current CAMPUS_NETWORKS setting, building it if necessary.
+    """
+    global _campus_network_matcher
+    matcher = _campus_network_matcher
+    if matcher is None:
+        matcher = _campus_network_matcher = CampusNetworkMatcher(getattr(settings, 'CAMPUS_NETWORKS', None) or [])
+    return matcher
+
+
+# noinspection PyUnusedLocal
+@receiver(setting_changed)
+def reset_campus_network_matcher(sender, setting, **kwargs):
+    """
+    Throws away the CampusNetworkMatcher when CAMPUS_NETWORKS changes (e.g. in tests).
+    """
+    global _campus_network_matcher
+    if setting == 'CAMPUS_NETWORKS':
+        _campus_network_matcher = None
+
+
+def request_is_on_campus(request, check=None):
+    """
+    Returns True if the given request comes from a campus network, memoizing the answer on the request. Pass check to
+    decide that some other way than with CAMPUS_NETWORKS; it's called with the request, at most once per request.
+    """
+    try:
+        return request._is_on_campus
+    except AttributeError:
+        pass
+    if check is not None:
+        request._is_on_campus = bool(check(request))
+    else:
+        request._is_on_campus = get_client_ip(request) in get_campus_network_matcher()
+    return request._is_on_campus
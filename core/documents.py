@@ -0,0 +1,432 @@
+"""
+Serves Documents that live in a storage backend without local file paths (i.e. S3), with support for conditional GETs
+and byte-range requests, so that clients and proxies can revalidate, resume, and seek within large files.
+
+How a Document is served depends on its file extension's serve mode (see get_serve_mode()):
+ * 'proxy' streams the file through this process, with serve_stored_file().
+ * 'redirect' redirects the client to a short-lived presigned S3 URL, so S3 sends the file itself.
+ * 'accel' hands a presigned S3 URL to nginx in an X-Accel-Redirect header, so nginx fetches and sends the file.
+The last two never tie up a gunicorn worker for the length of the download. Access checks must be done before any of
+them, since anyone with a presigned URL can use it until it expires.
+
+Everything document_serve needs to know about a Document (its access flags, filename, and file metadata) is kept in
+the cache as a DocumentMetadata, which is stored when the Document is uploaded or saved and deleted along with it (see
+core.signals). So serving a Document usually costs no database queries and no storage requests, besides reading its
+content.
+
+Each response is built from the stored file's metadata (its size, modification time and ETag), which costs one HEAD
+request against S3. Requests whose If-None-Match or If-Modified-Since validators match are answered with a 304 without
+reading the file at all, and range requests only read the requested bytes, with ranged GETs against S3.
+"""
+import hashlib
+import mimetypes
+import os
+from calendar import timegm
+from collections import namedtuple
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache
+from django.http import BadHeaderError, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, add_never_cache_headers
+from django.utils.functional import cached_property
+from django.utils.http import http_date, quote_etag
+from unidecode import unidecode
+from wagtail.wagtaildocs.models import get_document_model
+
+from core.logging import logger
+
+# Clients which ask for more ranges than this are sent the whole file instead, which RFC 7233 allows.
+MAX_RANGES = 16
+CHUNK_SIZE = 64 * 1024
+
+SERVE_MODES = ('proxy', 'redirect', 'accel')
+
+DOCUMENT_METADATA_KEY = 'document-metadata'
+DOCUMENT_METADATA_TIMEOUT = 60 * 60 * 24 * 7
+
+# s3_key is the file's key in its storage's S3 bucket, or None if the storage isn't S3.
+FileMetadata = namedtuple('FileMetadata', ['size', 'last_modified', 'etag', 's3_key'])
+
+# file is the FileMetadata of the Document's file.
+DocumentMetadata = namedtuple('DocumentMetadata', [
+    'id', 'title', 'file_name', 'content_type', 'on_campus_only', 'login_required', 'collection_id', 'file'
+])
+
+
+class StoredFile(object):
+    """
+    A file in a storage backend, which is only opened once something needs it. If the storage is django-storages'
+    S3Boto3Storage, its metadata and byte ranges are read through the file's boto3 Object, rather than by downloading
+    the whole file.
+
+    Pass in the file's FileMetadata if it's already known (e.g. from the document metadata cache), and the file can be
+    served without any requests to storage beyond reading its content.
+    """
+
+    def __init__(self, field_file, metadata=None):
+        self.storage = field_file.storage
+        self.name = field_file.name
+        self.metadata = metadata
+
+    @cached_property
+    def file(self):
+        return self.storage.open(self.name, 'rb')
+
+    @cached_property
+    def s3_object(self):
+        if self.metadata is not None:
+            # Opening the file would cost a HEAD request, whereas boto3 Objects don't make any requests until used.
+            return self.storage.bucket.Object(self.metadata.s3_key) if self.metadata.s3_key is not None else None
+        return getattr(self.file, 'obj', None)
+
+    def get_metadata(self):
+        if self.metadata is None:
+            self.metadata = self.read_metadata()
+        return self.metadata
+
+    def read_metadata(self):
+        """
+        Reads the file's FileMetadata from storage. S3 provides all of it with one HEAD request. Other storages get an
+        ETag derived from the file's name, size and modification time.
+        """
+        # The file is open now, so use its Object from here on.
+        s3_object = self.__dict__['s3_object'] = getattr(self.file, 'obj', None)
+        if s3_object is not None:
+            return FileMetadata(s3_object.content_length, s3_object.last_modified, s3_object.e_tag, s3_object.key)
+
+        size = self.storage.size(self.name)
+        try:
+            last_modified = self.storage.get_modified_time(self.name)
+        except (NotImplementedError, AttributeError):
+            last_modified = None
+        etag = hashlib.md5('{}:{}:{}'.format(self.name, size, last_modified).encode('utf-8')).hexdigest()
+        return FileMetadata(size, last_modified, quote_etag(etag), None)
+
+    def iter_range(self, start, end):
+        """
+        Yields the bytes from start to end (inclusive) of the file, in chunks of up to CHUNK_SIZE. Each range of a file
+        in S3 gets its own ranged GET, whose body is closed afterwards. Other files are read from the one open file,
+        which is left open for the next range; close() closes it.
+        """
+        remaining = end - start + 1
+        if remaining <= 0:
+            return
+        s3_body = None
+        if self.s3_object is not None:
+            body = s3_body = self.s3_object.get(Range='bytes={}-{}'.format(start, end))['Body']
+        else:
+            body = self.file
+            body.seek(start)
+        try:
+            while remaining > 0:
+                chunk = body.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            if s3_body is not None:
+                s3_body.close()
+
+    def close(self):
+        """
+        Closes the file, if it was ever opened.
+        """
+        if 'file' in self.__dict__:
+            self.file.close()
+
+
+def parse_range_header(header, size):
+    """
+    Parses the value of a Range header for a file of the given size. Returns a sorted list of (start, end) pairs of
+    inclusive byte offsets, with overlapping and adjacent ranges merged. Returns an empty list if none of the ranges can
+    be satisfied, and None if the header is missing, malformed, or asks for too many ranges, all of which mean that the
+    whole file should be sent.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    specs = header[len('bytes='):].split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                if not last:
+                    end = size - 1
+                elif int(last) < start:
+                    return None
+                else:
+                    end = int(last)
+            else:
+                # A suffix range, e.g. "-500" for the last 500 bytes.
+                length = int(last)
+                start = max(size - length, 0)
+                end = size - 1 if length else -1
+        except ValueError:
+            return None
+        if start < size and start <= end:
+            ranges.append((start, min(end, size - 1)))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_passes(request, validators):
+    """
+    Returns True if the request has no If-Range header, or if its If-Range matches the file's current ETag or
+    Last-Modified date, meaning that a range request may be answered with just the requested ranges.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    return if_range in (validators.get('ETag'), validators.get('Last-Modified'))
+
+
+def serve_stored_file(request, stored_file, content_type='application/octet-stream'):
+    """
+    Returns a response which serves the given StoredFile, honoring the request's conditional and Range headers. The
+    caller is responsible for adding headers like Content-Disposition. The StoredFile is closed along with the response.
+    """
+    response = build_stored_file_response(request, stored_file, content_type)
+    # Like FileResponse, leave closing the file to the handler, which closes the response once it's been sent.
+    response._closable_objects.append(stored_file)
+    return response
+
+
+def build_stored_file_response(request, stored_file, content_type):
+    metadata = stored_file.get_metadata()
+
+    validators = HttpResponse()
+    validators['ETag'] = metadata.etag
+    last_modified = None
+    if metadata.last_modified is not None:
+        last_modified = timegm(metadata.last_modified.utctimetuple())
+        validators['Last-Modified'] = http_date(last_modified)
+    conditional_response = get_conditional_response(
+        request, etag=metadata.etag, last_modified=last_modified, response=validators
+    )
+    if conditional_response is not validators:
+        # A 304 Not Modified, or a 412 Precondition Failed.
+        return conditional_response
+
+    ranges = None
+    if if_range_passes(request, validators):
+        ranges = parse_range_header(request.META.get('HTTP_RANGE'), metadata.size)
+
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(metadata.size)
+        return response
+
+    # Don't read anything from storage for a HEAD request.
+    read = (lambda start, end: iter(())) if request.method == 'HEAD' else stored_file.iter_range
+    if ranges is None:
+        response = StreamingHttpResponse(read(0, metadata.size - 1), content_type=content_type)
+        response['Content-Length'] = metadata.size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(read(start, end), content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, metadata.size)
+        response['Content-Length'] = end - start + 1
+    else:
+        boundary = uuid4().hex
+        parts = [
+            (
+                '--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                    boundary, content_type, start, end, metadata.size
+                ).encode('ascii'),
+                start,
+                end,
+            )
+            for start, end in ranges
+        ]
+        closing = '--{}--\r\n'.format(boundary).encode('ascii')
+
+        def stream_parts():
+            for part_header, start, end in parts:
+                yield part_header
+                for chunk in read(start, end):
+                    yield chunk
+                yield b'\r\n'
+            yield closing
+
+        response = StreamingHttpResponse(
+            stream_parts(), content_type='multipart/byteranges; boundary={}'.format(boundary), status=206
+        )
+        response['Content-Length'] = sum(len(header) + end - start + 3 for header, start, end in parts) + len(closing)
+
+    for header in ('ETag', 'Last-Modified'):
+        if header in validators:
+            response[header] = validators[header]
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def get_serve_mode(filename):
+    """
+    Returns the serve mode for a Document with the given filename: the DOCUMENT_SERVE_MODES entry for its extension,
+    or DOCUMENT_SERVE_MODE if it has none.
+    """
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    modes = getattr(settings, 'DOCUMENT_SERVE_MODES', {})
+    mode = modes.get(extension, getattr(settings, 'DOCUMENT_SERVE_MODE', 'proxy'))
+    return mode if mode in SERVE_MODES else 'proxy'
+
+
+def set_content_disposition(response, filename):
+    try:
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    except BadHeaderError:
+        # Unicode filenames can fail on Django <1.8, Python 2 due to
+        # https://code.djangoproject.com/ticket/20889 - try with an ASCIIfied version of the name
+        response['Content-Disposition'] = 'attachment; filename=%s' % unidecode(filename)
+
+
+def get_presigned_url(stored_file, filename):
+    """
+    Returns a presigned URL for the given StoredFile's S3 object, which makes S3 send the file as an attachment with the
+    given filename. It expires after DOCUMENT_PRESIGNED_URL_TIMEOUT seconds.
+    """
+    s3_object = stored_file.s3_object
+    return s3_object.meta.client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': s3_object.bucket_name,
+            'Key': s3_object.key,
+            # S3 echoes this back verbatim, so keep it ASCII.
+            'ResponseContentDisposition': 'attachment; filename=%s' % unidecode(filename),
+        },
+        ExpiresIn=getattr(settings, 'DOCUMENT_PRESIGNED_URL_TIMEOUT', 60),
+    )
+
+
+def serve_document_file(request, field_file, filename, mode='proxy', content_type='application/octet-stream',
+                        metadata=None):
+    """
+    Returns a response which serves the given FieldFile as an attachment with the given filename, in the given serve
+    mode. Files which aren't in S3 are always proxied. Pass in the file's FileMetadata if it's already known.
+    """
+    stored_file = StoredFile(field_file, metadata)
+    if mode == 'proxy' or stored_file.s3_object is None:
+        response = serve_stored_file(request, stored_file, content_type)
+        if response.status_code in (200, 206):
+            set_content_disposition(response, filename)
+        return response
+
+    url = get_presigned_url(stored_file, filename)
+    if mode == 'redirect':
+        response = HttpResponseRedirect(url)
+    else:
+        # nginx keeps this response's Content-Type and Content-Disposition when it serves the file at the new location.
+        response = HttpResponse(content_type=content_type)
+        # The prefix is an internal nginx location which proxies to the URL that follows it, minus its scheme.
+        prefix = getattr(settings, 'DOCUMENT_ACCEL_REDIRECT_PREFIX', '/protected-s3/')
+        response['X-Accel-Redirect'] = prefix + url.split('://', 1)[1]
+        set_content_disposition(response, filename)
+    # Neither the presigned URL nor the outcome of the access checks may be cached and reused by anyone else.
+    add_never_cache_headers(response)
+    return response
+
+
+def get_document_metadata_key(document_id):
+    return '{}-{}'.format(DOCUMENT_METADATA_KEY, document_id)
+
+
+def build_document_metadata(doc):
+    """
+    Builds the given Document's DocumentMetadata, which costs one HEAD request for a file in S3.
+    """
+    stored_file = StoredFile(doc.file)
+    try:
+        file_metadata = stored_file.read_metadata()
+    finally:
+        stored_file.close()
+    metadata = DocumentMetadata(
+        id=doc.pk,
+        title=doc.title,
+        file_name=doc.file.name,
+        content_type=mimetypes.guess_type(doc.filename)[0] or 'application/octet-stream',
+        on_campus_only=doc.on_campus_only,
+        login_required=doc.login_required,
+        collection_id=doc.collection_id,
+        file=file_metadata,
+    )
+    return metadata
+
+
+def cache_document_metadata(doc):
+    """
+    Builds the given Document's DocumentMetadata and caches it, replacing whatever was cached before.
+    """
+    metadata = build_document_metadata(doc)
+    cache.set(get_document_metadata_key(doc.pk), metadata, DOCUMENT_METADATA_TIMEOUT)
+    return metadata
+
+
+def refresh_document_metadata(doc):
+    """
+    Replaces the given Document's cached DocumentMetadata, e.g. because it was just uploaded or edited. If that fails,
+    the Document's metadata is left out of the cache, to be built when it's next served.
+    """
+    forget_document_metadata(doc.pk)
+    try:
+        cache_document_metadata(doc)
+    except Exception:
+        logger.exception('document.metadata.failed', document=doc.pk)
+
+
+def forget_document_metadata(*document_ids):
+    cache.delete_many([get_document_metadata_key(document_id) for document_id in document_ids])
+
+
+def get_document_metadata(document_id):
+    """
+    Returns the DocumentMetadata of the Document with the given id, from the cache if possible. Returns None if there's
+    no such Document.
+
+    On a miss, the metadata is only added to the cache if it's still missing once it's built. The Document may have
+    been saved while its file's metadata was being read, and then the record that its save stored is the fresher one.
+    """
+    key = get_document_metadata_key(document_id)
+    metadata = cache.get(key)
+    if metadata is None:
+        Document = get_document_model()
+        try:
+            doc = Document.objects.get(pk=document_id)
+        except Document.DoesNotExist:
+            return None
+        metadata = build_document_metadata(doc)
+        cache.add(key, metadata, DOCUMENT_METADATA_TIMEOUT)
+    return metadata
+
+
+def get_cached_document(document_id):
+    """
+    Returns the Document with the given id, rebuilt from its cached DocumentMetadata rather than loaded from the
+    database, or None if there's no such Document. It has only the fields that DocumentMetadata holds, and its
+    DocumentMetadata as its document_metadata attribute.
+    """
+    metadata = get_document_metadata(int(document_id))
+    if metadata is None:
+        return None
+    doc = get_document_model()(
+        id=metadata.id,
+        title=metadata.title,
+        file=metadata.file_name,
+        on_campus_only=metadata.on_campus_only,
+        login_required=metadata.login_required,
+        collection_id=metadata.collection_id,
+    )
+    doc.document_metadata = metadata
+    return doc
@@ -0,0 +1,223 @@
+"""
+A materialized copy of each Site's menu, stored in the default (redis) cache, so that rendering the menu doesn't need
+any database queries.
+
+Each Site's menu tree is stored as a (version, root_url_path, entries) triple, where entries is a list of
+(pk, path, depth, title, url_path, content_type_id) tuples for every live, on-menu descendant of the Site's root page,
+ordered by path. It's built with a single query the first time it's needed, then kept up to date one Page at a time as
+Pages are published, unpublished and deleted (see core.signals), and thrown away when Pages are moved. Entries are
+always loaded from the database, never from the Page instance that was saved, since that might hold unpublished changes.
+
+version is the value of the Site's menu version counter (see core.utils.get_cache_version()) that the tree is current
+for. It's read before the tree is built, and every change bumps it once its transaction has committed, so a tree built
+from a query that raced a change gets stored under an older version, and is rebuilt the next time it's needed instead
+of being served for the rest of MENU_TREE_TIMEOUT.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from wagtail.wagtailcore.models import Page
+
+from core.routing import site_routing_table
+from core.utils import get_cache_version, bump_cache_version
+
+MENU_TREE_KEY = 'menu-tree'
+MENU_TREE_VERSION_KEY = 'menu-tree-version'
+MENU_TREE_TIMEOUT = 60 * 60 * 24
+
+# The fields of each menu tree entry, and their indexes.
+ENTRY_FIELDS = ('pk', 'path', 'depth', 'title', 'url_path', 'content_type_id')
+PK, PATH, DEPTH, TITLE, URL_PATH, CONTENT_TYPE_ID = range(len(ENTRY_FIELDS))
+
+
+class MenuPage(object):
+    """
+    A lightweight stand-in for a Page in a menu tree, with just the fields that menus need. The real Page (as its
+    specific subclass) is fetched only if something asks for it.
+    """
+
+    def __init__(self, entry, root_url_path):
+        self.pk = self.id = entry[PK]
+        self.path = entry[PATH]
+        self.depth = entry[DEPTH]
+        self.title = entry[TITLE]
+        self.url_path = entry[URL_PATH]
+        self.content_type_id = entry[CONTENT_TYPE_ID]
+        # Menu pages always belong to the current Site, so their URLs are relative to its root page. Like
+        # Page.get_url_parts(), leave off the trailing slash unless WAGTAIL_APPEND_SLASH is on.
+        self.url = self.url_path[len(root_url_path) - 1:]
+        if not getattr(settings, 'WAGTAIL_APPEND_SLASH', True) and self.url != '/':
+            self.url = self.url.rstrip('/')
+
+    @property
+    def specific(self):
+        """
+        The real Page, as an instance of its specific subclass. Fetching these one at a time costs two queries each, so
+        templates which need per-type fields from many MenuPages should get them with prefetch_specific() first.
+        """
+        try:
+            return self._specific
+        except AttributeError:
+            self._specific = Page.objects.get(pk=self.pk).specific
+            return self._specific
+
+    def __eq__(self, other):
+        return getattr(other, 'pk', None) == self.pk
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __repr__(self):
+        return '<MenuPage: {}>'.format(self.title)
+
+
+def get_menu_tree_key(site_pk):
+    return '{}-{}'.format(MENU_TREE_KEY, site_pk)
+
+
+def get_menu_tree_version_key(site_pk):
+    return '{}-{}'.format(MENU_TREE_VERSION_KEY, site_pk)
+
+
+def build_menu_tree(site, version):
+    """
+    Loads the given Site's menu tree from the database, and stores it in the cache as the tree for the given version,
+    which must have been read before calling this.
+    """
+    pages = Page.objects.descendant_of(site.root_page, inclusive=False).filter(show_in_menus=True, live=True)
+    entries = list(pages.order_by('path').values_list(*ENTRY_FIELDS))
+    tree = (version, site.root_page.url_path, entries)
+    cache.set(get_menu_tree_key(site.pk), tree, MENU_TREE_TIMEOUT)
+    return tree
+
+
+def get_menu_tree(site):
+    """
+    Returns the (root_url_path, entries) pair for the given Site, building it first if the cached tree is missing or out
+    of date.
+    """
+    version = get_cache_version(get_menu_tree_version_key(site.pk))
+    tree = cache.get(get_menu_tree_key(site.pk))
+    if tree is None or tree[0] != version:
+        tree = build_menu_tree(site, version)
+    return tree[1:]
+
+
+def get_menu_pages(site, max_depth=None):
+    """
+    Returns a MenuPage for each entry in the given Site's menu tree, ordered by path. Pass max_depth to leave out any
+    Pages more than that many levels below the Site's homepage.
+    """
+    root_url_path, entries = get_menu_tree(site)
+    if max_depth is not None:
+        # The Root page and the Site's homepage live at depths 1 and 2, which is why we add 2 to max_depth.
+        entries = [entry for entry in entries if entry[DEPTH] <= max_depth + 2]
+    return [MenuPage(entry, root_url_path) for entry in entries]
+
+
+def prefetch_specific(menu_pages):
+    """
+    Fetches the specific Page for each of the given MenuPages, with one query per Page type among them, rather than two
+    queries per MenuPage.
+    """
+    pages_by_content_type = defaultdict(list)
+    for menu_page in menu_pages:
+        if not hasattr(menu_page, '_specific'):
+            pages_by_content_type[menu_page.content_type_id].append(menu_page)
+
+    for content_type_id, pages in pages_by_content_type.items():
+        # get_for_id() is served from ContentTypeManager's cache.
+        model = ContentType.objects.get_for_id(content_type_id).model_class() or Page
+        instances = model._default_manager.in_bulk([menu_page.pk for menu_page in pages])
+        for menu_page in pages:
+            if menu_page.pk in instances:
+                menu_page._specific = instances[menu_page.pk]
+    return menu_pages
+
+
+@contextmanager
+def menu_tree_lock(site_pk):
+    """
+    Serializes updates to the given Site's menu tree across processes, when the cache supports locks.
+    """
+    lock = getattr(cache, 'lock', None)
+    if lock is None:
+        yield
+    else:
+        with lock('{}-lock'.format(get_menu_tree_key(site_pk)), timeout=10):
+            yield
+
+
+def update_menu_tree(site, path, row=None):
+    """
+    Updates the given Site's cached menu tree to reflect the live state of the Page at the given path, which was just
+    published or unpublished. row is the Page's ENTRY_FIELDS, followed by its live and show_in_menus fields, as loaded
+    from the database. Pass None for a Page which was deleted, along with its descendants.
+
+    If publishing the Page changed its slug, it also changed its descendants' url_paths, so the tree is thrown away to
+    be rebuilt from scratch instead.
+
+    This must only be called once the change has been committed. The updated tree is stored under a newly bumped
+    version, so that a tree which a concurrent request built from before the change can never replace it.
+    """
+    key = get_menu_tree_key(site.pk)
+    version_key = get_menu_tree_version_key(site.pk)
+    with menu_tree_lock(site.pk):
+        version = get_cache_version(version_key)
+        tree = cache.get(key)
+        if tree is None or tree[0] != version:
+            # There's nothing up to date to update. A tree which is being built right now may or may not include this
+            # change, so make sure it's rebuilt when it's next needed.
+            forget_menu_tree(site.pk)
+            return
+        _, root_url_path, entries = tree
+        # Entries are ordered by path, so the Page's entry (if any) is followed immediately by its descendants'.
+        start = end = bisect_left([entry[PATH] for entry in entries], path)
+        while end < len(entries) and entries[end][PATH].startswith(path):
+            end += 1
+
+        if row is None:
+            del entries[start:end]
+        else:
+            if any(not entry[URL_PATH].startswith(row[URL_PATH]) for entry in entries[start:end]):
+                forget_menu_tree(site.pk)
+                return
+            if start < end and entries[start][PATH] == path:
+                del entries[start]
+            live, show_in_menus = row[len(ENTRY_FIELDS):]
+            if live and show_in_menus and row[PK] != site.root_page_id:
+                entries.insert(start, row[:len(ENTRY_FIELDS)])
+        cache.set(key, (bump_cache_version(version_key), root_url_path, entries), MENU_TREE_TIMEOUT)
+
+
+def update_menu_trees_for_page(page_pk, path):
+    """
+    Updates the menu tree of every Site that contains the Page with the given pk and path, from the Page's current row
+    in the database. If the Page no longer exists, it and its descendants are removed from the trees.
+    """
+    row = Page.objects.filter(pk=page_pk).values_list(*(ENTRY_FIELDS + ('live', 'show_in_menus'))).first()
+    routes = site_routing_table.get_routes()
+    for site_pk in site_routing_table.site_pks_for_path(path):
+        update_menu_tree(routes.sites[site_pk], path, row)
+
+
+def forget_menu_trees_for_paths(*paths):
+    """
+    Throws away the menu tree of every Site that contains any of the given paths, e.g. because a Page was moved from
+    one of them to another, which changes the paths and url_paths of its whole subtree.
+    """
+    for path in paths:
+        for site_pk in site_routing_table.site_pks_for_path(path):
+            forget_menu_tree(site_pk)
+
+
+def forget_menu_tree(site_pk):
+    """
+    Throws away the given Site's menu tree, e.g. because its root page changed. Like update_menu_tree(), this must only
+    be called once the change has been committed.
+    """
+    bump_cache_version(get_menu_tree_version_key(site_pk))
+    cache.delete(get_menu_tree_key(site_pk))
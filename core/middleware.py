@@ -1,8 +1,6 @@
 from __future__ import absolute_import
 
-import threading
-from collections import defaultdict
-from crequest.middleware import CrequestMiddleware
+from django.conf import settings
 from django.core.exceptions import MiddlewareNotUsed
 from django.utils.cache import add_never_cache_headers
 from django.contrib import messages
@@ -10,8 +8,12 @@ from django.contrib.auth import logout
 from django.http.response import HttpResponsePermanentRedirect, HttpResponseBadRequest
 from django.utils.deprecation import MiddlewareMixin
 from django.utils.http import urlencode
+from djunk import request_context
+from djunk.middleware import CurrentRequestMiddleware
 from wagtail.wagtailcore.models import Site
 
+from core import page_cache
+from core.tenants import tenant_snapshots
 from core.utils import match_site_to_request, user_is_member_of_site, MissingHostException
 from core.logging import logger
 
@@ -22,6 +24,7 @@ class MultitenantSiteMiddleware(MiddlewareMixin):
         """
         Set request.site to the Site object responsible for handling this request. Wagtail's version of this
         middleware only looks at the Sites' hostnames. Ours must also consider the Sites' lists of aliases.
+        Also sets request.tenant to that Site's TenantSnapshot (see core.tenants).
 
         This middleware also denies access to users who have valid accounts, but aren't members of the current Site.
         """
@@ -34,10 +37,13 @@ class MultitenantSiteMiddleware(MiddlewareMixin):
                 hostname = None
             logger.warning('site.does_not_exist', hostname=hostname)
             request.site = None
+            request.tenant = None
         except MissingHostException:
             # If no hostname was specified, we return a 400 error. This should really only happen during tests.
             return HttpResponseBadRequest()
         else:
+            request.tenant = tenant_snapshots.get(request.site)
+
             # When a user visits an admin page via an alias or a non-https URL, we need to redirect them to the https
             # version of the Site's canonical domain (so the SSL cert will work).
             if request.path.startswith('/admin/') and (match_type == 'alias' or not request.is_secure()):
@@ -51,7 +57,7 @@ class MultitenantSiteMiddleware(MiddlewareMixin):
             if (
                 not request.user.is_anonymous and
                 not request.user.is_superuser and
-                not user_is_member_of_site(request.user, request.site)
+                not user_is_member_of_site(request.user, request.site, request)
             ):
                 messages.error(request, 'Invalid credentials.')
                 logger.warning(
@@ -60,7 +66,7 @@ class MultitenantSiteMiddleware(MiddlewareMixin):
                 logout(request)
 
 
-class MultitenantCrequestMiddleware(CrequestMiddleware):
+class MultitenantCrequestMiddleware(CurrentRequestMiddleware):
 
     def __init__(self, get_response=None):
         # Skip this middleware if the middleware chain has already run at least once.
@@ -79,29 +85,63 @@ class MiddlewareIterationCounter(object):
 
     By counting the interations of the middleware chain, we can subclass problematic middleware to make them exclude
     themselves from subsequent iterations.
-    """
 
-    _iterations = defaultdict(int)
+    The count is kept in a context variable (see djunk.request_context) rather than a dict keyed by thread, so that it
+    stays correct when requests are served by threads, greenlets, or asyncio tasks.
+    """
 
     def __init__(self, get_response=None):
         self.get_response = get_response
 
     def __call__(self, request):
-        current_thread = threading.current_thread()
-        # Increment the current thread's interation counter on ingress.
-        self._iterations[current_thread] += 1
-        response = self.get_response(request)
-        # Decrement the current thread's interation counter on egress.
-        self._iterations[current_thread] -= 1
-        # If we're down to 0 interations, delete the counter to avoid a memory leak.
-        if self._iterations[current_thread] == 0:
-            del self._iterations[current_thread]
-        return response
+        # Increment the current context's interation counter on ingress, and restore it on egress. Since the counter
+        # belongs to the context, there's nothing left behind to leak.
+        token = request_context.increment_middleware_iterations()
+        try:
+            return self.get_response(request)
+        finally:
+            request_context.reset_middleware_iterations(token)
 
     @classmethod
     def get_iteration_count(cls):
         """
-        Returns the iteration count for the current thread.
-        Since cls._iterations is a defaultdict, this can safely be called before the first increment, which returns 0.
+        Returns the iteration count for the current context, which is 0 outside of the middleware chain.
         """
-        return cls._iterations[threading.current_thread()]
+        return request_context.get_middleware_iterations()
+
+
+class AnonymousPageCacheMiddleware(MiddlewareMixin):
+    """
+    Serves anonymous visitors' GET and HEAD requests from a per-tenant cache of rendered responses (see
+    core.page_cache), and labels cacheable responses with Surrogate-Key and Surrogate-Control headers so that an edge
+    cache in front of the servers can store them too, and purge them by tenant.
+
+    This must come after MultitenantSiteMiddleware, since cached responses are keyed by request.site. That puts it after
+    the session, CSRF and messages middleware, so it sees responses before they add their cookies and Vary headers;
+    see page_cache.response_is_cacheable() for how it accounts for them.
+    """
+
+    def __init__(self, get_response=None):
+        if not getattr(settings, 'PAGE_CACHE_ENABLED', False):
+            raise MiddlewareNotUsed
+        super(AnonymousPageCacheMiddleware, self).__init__(get_response)
+
+    def process_request(self, request):
+        request._page_cache_eligible = page_cache.request_is_cacheable(request)
+        if not request._page_cache_eligible:
+            return None
+        response = page_cache.get_cached_response(request)
+        if response is not None:
+            response['X-Page-Cache'] = 'HIT'
+        return response
+
+    def process_response(self, request, response):
+        if (
+            getattr(request, '_page_cache_eligible', False) and
+            request.method == 'GET' and
+            'X-Page-Cache' not in response and
+            page_cache.response_is_cacheable(request, response)
+        ):
+            page_cache.store_response(request, response)
+            response['X-Page-Cache'] = 'MISS'
+        return response
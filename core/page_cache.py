@@ -0,0 +1,126 @@
+"""
+A full-response cache for the front-end pages that anonymous visitors see. See AnonymousPageCacheMiddleware.
+
+Cached responses are keyed by Site pk, scheme, path, and a normalized query string, and stored in the default (redis)
+cache. Each Site's keys also include that Site's page cache version, so bumping the version (see
+invalidate_site_page_cache()) makes every cached response for the Site unreachable at once, leaving them to expire on
+their own. Narrower changes evict only the responses which depend on them, via the cache tags each response is stored
+under (see core.cache_tags).
+"""
+import hashlib
+from six.moves.urllib.error import URLError
+from six.moves.urllib.request import Request, urlopen
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import patch_vary_headers
+from django.utils.http import urlencode
+
+from core.cache_tags import get_request_tags, set_tagged, site_tag
+from core.logging import logger
+from core.utils import get_cache_version, bump_cache_version
+
+PAGE_CACHE_VERSION_KEY = 'page-cache-version'
+
+
+def get_site_page_cache_version_key(site_pk):
+    return '{}-{}'.format(PAGE_CACHE_VERSION_KEY, site_pk)
+
+
+def normalize_query_string(query_dict):
+    """
+    Returns a canonical version of the given QueryDict, sorted by key and without the tracking parameters listed in
+    the PAGE_CACHE_IGNORED_QUERY_PARAMS setting, so that equivalent URLs share a cache entry.
+    """
+    ignored = getattr(settings, 'PAGE_CACHE_IGNORED_QUERY_PARAMS', ())
+    return urlencode(sorted((key, values) for key, values in query_dict.lists() if key not in ignored), True)
+
+
+def get_page_cache_key(request):
+    """
+    Returns the cache key for the response to the given request, which must have a Site.
+    """
+    version = get_cache_version(get_site_page_cache_version_key(request.site.pk))
+    url = '{}://{}?{}'.format(request.scheme, request.path, normalize_query_string(request.GET))
+    return 'page-cache:{}:{}:{}'.format(request.site.pk, version, hashlib.md5(url.encode('utf-8')).hexdigest())
+
+
+def request_is_cacheable(request):
+    """
+    Only GET and HEAD requests from visitors without a session cookie are served from the cache. The logout view
+    deletes the session cookie specifically so that this is a reliable sign of an anonymous visitor. Visitors with
+    pending messages (which the messages framework keeps in a cookie) need a freshly rendered page to see them.
+    """
+    return (
+        request.method in ('GET', 'HEAD') and
+        getattr(request, 'site', None) is not None and
+        settings.SESSION_COOKIE_NAME not in request.COOKIES and
+        CookieStorage.cookie_name not in request.COOKIES and
+        not request.path.startswith(('/admin/', '/django-admin/'))
+    )
+
+
+def response_is_cacheable(request, response):
+    """
+    Responses which set cookies, embed a CSRF token, stream, or ask not to be cached must never be stored, since
+    they'd be served to other visitors.
+
+    AnonymousPageCacheMiddleware sees each response before the session, CSRF and messages middleware add their cookies
+    to it, so this also checks for the changes which will make them do so.
+    """
+    cache_control = response.get('Cache-Control', '')
+    session = getattr(request, 'session', None)
+    messages = getattr(request, '_messages', None)
+    return (
+        response.status_code == 200 and
+        not response.streaming and
+        not response.cookies and
+        not request.META.get('CSRF_COOKIE_USED') and
+        not (session is not None and session.modified) and
+        not (messages is not None and messages.added_new) and
+        not any(directive in cache_control for directive in ('private', 'no-cache', 'no-store'))
+    )
+
+
+def get_cached_response(request):
+    return cache.get(get_page_cache_key(request))
+
+
+def store_response(request, response):
+    """
+    Stores the given response for the given request under the cache tags recorded while it was rendered (see
+    core.cache_tags), and labels it with the headers an edge cache needs to cache it and later purge it by tag.
+    """
+    timeout = settings.PAGE_CACHE_TIMEOUT
+    tags = get_request_tags(request)
+    if getattr(getattr(request, 'session', None), 'accessed', False):
+        # SessionMiddleware will add this header to the response too, but only after it has been stored.
+        patch_vary_headers(response, ('Cookie',))
+    response['Surrogate-Key'] = ' '.join(sorted(tags))
+    response['Surrogate-Control'] = 'max-age={}'.format(timeout)
+    set_tagged(get_page_cache_key(request), response, tags, timeout)
+
+
+def purge_surrogate_keys(keys):
+    """
+    Asks each edge cache listed in the PAGE_CACHE_PURGE_URLS setting to purge everything filed under the given
+    Surrogate-Keys. Failures are logged rather than raised, since cached responses will expire on their own.
+    """
+    for url in getattr(settings, 'PAGE_CACHE_PURGE_URLS', []):
+        purge_request = Request(url, method='PURGE', headers={'Surrogate-Key': ' '.join(keys)})
+        try:
+            urlopen(purge_request, timeout=5).close()
+        except (URLError, OSError) as err:
+            logger.warning('page_cache.purge.failed', url=url, keys=keys, reason=str(err))
+
+
+def invalidate_site_page_cache(site_pk):
+    """
+    Makes every cached response for the given Site stale, in this cache and in any edge caches. This happens once the
+    current transaction commits, so that a concurrent request can't re-cache the old content.
+    """
+    def invalidate():
+        bump_cache_version(get_site_page_cache_version_key(site_pk))
+        purge_surrogate_keys([site_tag(site_pk)])
+    transaction.on_commit(invalidate)
@@ -0,0 +1,173 @@
+"""
+A per-user index of page permissions, so that "can this user do X to this page?" can be answered without a query.
+
+Wagtail derives a user's permissions on a page from every GroupPagePermission, in any of the user's Groups, on the page
+or one of its ancestors. PagePermissionIndex holds those GroupPagePermissions as a sorted list of page paths, each with
+a bitmask of the permission types granted on it, so a page's permissions are the union of the masks found by binary
+searching for each prefix of the page's path.
+
+Each user's index is built with one query, stored in the cache, and memoized on the User object for the rest of the
+request. It's rebuilt whenever any GroupPagePermission changes, a page is moved, or the User's Groups change. Those
+changes bump the versions that the cached index is stored under once they're committed, not before, so that a
+concurrent request can't store an index built from the old data under the new versions.
+"""
+from bisect import bisect_left
+from functools import reduce
+from operator import or_
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, When, Q, Max, IntegerField
+from django.db.models.functions import Substr
+from djunk.middleware import get_current_user
+from wagtail.wagtailcore.models import Page, GroupPagePermission, PAGE_PERMISSION_TYPES
+
+from core.utils import get_cache_version, bump_cache_version, get_site_membership_versions
+
+PAGE_PERMISSION_VERSION_KEY = 'page-permission-version'
+PAGE_PERMISSION_INDEX_KEY = 'page-permission-index'
+PAGE_PERMISSION_INDEX_TIMEOUT = 60 * 60 * 24
+
+PERMISSION_BITS = {identifier: 1 << bit for bit, (identifier, _, _) in enumerate(PAGE_PERMISSION_TYPES)}
+
+
+class PagePermissionIndex(object):
+
+    def __init__(self, entries):
+        """
+        entries is a list of (path, mask) pairs, sorted by path.
+        """
+        self.paths = [path for path, mask in entries]
+        self.masks = [mask for path, mask in entries]
+
+    def get_mask(self, path):
+        """
+        Returns the bitmask of the permissions granted on the page at the given path, directly or by an ancestor.
+        """
+        mask = 0
+        for end in range(Page.steplen, len(path) + 1, Page.steplen):
+            prefix = path[:end]
+            index = bisect_left(self.paths, prefix)
+            if index < len(self.paths) and self.paths[index] == prefix:
+                mask |= self.masks[index]
+        return mask
+
+    def get_permissions(self, path):
+        """
+        Returns the set of permission types granted on the page at the given path, like PagePermissionTester's
+        permissions attribute.
+        """
+        mask = self.get_mask(path)
+        return {identifier for identifier, bit in PERMISSION_BITS.items() if mask & bit}
+
+    def get_paths_with(self, permission_types):
+        """
+        Returns the paths of the pages on which any of the given permission types are directly granted.
+        """
+        wanted = sum(PERMISSION_BITS[identifier] for identifier in permission_types)
+        return [path for path, mask in zip(self.paths, self.masks) if mask & wanted]
+
+
+def build_page_permission_entries(user):
+    masks = {}
+    permissions = GroupPagePermission.objects.filter(group__user=user).values_list('page__path', 'permission_type')
+    for path, permission_type in permissions:
+        masks[path] = masks.get(path, 0) | PERMISSION_BITS.get(permission_type, 0)
+    return sorted(masks.items())
+
+
+def get_page_permission_index(user):
+    """
+    Returns the given User's PagePermissionIndex, building and caching it first if the cached copy is missing or out
+    of date.
+    """
+    try:
+        return user._page_permission_index
+    except AttributeError:
+        pass
+
+    key = '{}-{}'.format(PAGE_PERMISSION_INDEX_KEY, user.pk)
+    versions = [get_cache_version(PAGE_PERMISSION_VERSION_KEY)] + get_site_membership_versions(user.pk)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == versions:
+        entries = cached[1]
+    else:
+        entries = build_page_permission_entries(user)
+        cache.set(key, (versions, entries), PAGE_PERMISSION_INDEX_TIMEOUT)
+
+    user._page_permission_index = PagePermissionIndex(entries)
+    return user._page_permission_index
+
+
+def forget_current_user_page_permission_index():
+    """
+    Throws away the PagePermissionIndex memoized on the current User, if there is one, so that the rest of this request
+    sees a change to their permissions.
+    """
+    user = get_current_user()
+    if user is not None and hasattr(user, '_page_permission_index'):
+        del user._page_permission_index
+
+
+def invalidate_page_permission_indexes():
+    """
+    Makes every User's cached PagePermissionIndex stale, once the current transaction commits. The current User's
+    memoized index is thrown away immediately.
+    """
+    forget_current_user_page_permission_index()
+    transaction.on_commit(lambda: bump_cache_version(PAGE_PERMISSION_VERSION_KEY))
+
+
+# The facts about a page's subtree (the page and its descendants) which PagePermissionTester.can_delete() needs, as
+# conditions which are 1 for the pages that make the fact true.
+SUBTREE_FLAGS = {
+    'has_live': lambda user: When(live=True, then=1),
+    'has_unowned': lambda user: When(~Q(owner_id=user.pk) | Q(owner__isnull=True), then=1),
+    'has_live_or_unowned': lambda user: When(Q(live=True) | ~Q(owner_id=user.pk) | Q(owner__isnull=True), then=1),
+}
+
+
+def prefetch_subtree_flags(pages, user):
+    """
+    Computes every SUBTREE_FLAGS fact for each of the given pages, with one aggregate query per distinct depth among
+    them (so a listing of siblings takes one query), and stores the results on the pages for subtree_has() to read.
+    The pages' subtrees must not overlap, e.g. because the pages are siblings.
+    """
+    pages_by_depth = {}
+    for page in pages:
+        pages_by_depth.setdefault(page.depth, []).append(page)
+
+    aggregates = {
+        flag: Max(Case(condition(user), default=0, output_field=IntegerField()))
+        for flag, condition in SUBTREE_FLAGS.items()
+    }
+    for depth, depth_pages in pages_by_depth.items():
+        in_subtrees = reduce(or_, [Q(path__startswith=page.path) for page in depth_pages])
+        rows = Page.objects.filter(in_subtrees).annotate(
+            subtree=Substr('path', 1, depth * Page.steplen)
+        ).values('subtree').annotate(**aggregates).order_by()
+        flags_by_path = {row['subtree']: row for row in rows}
+        for page in depth_pages:
+            row = flags_by_path.get(page.path, {})
+            page._subtree_flags = (user.pk, {flag: bool(row.get(flag)) for flag in SUBTREE_FLAGS})
+
+
+def subtree_has(page, user, flag):
+    """
+    Returns the given SUBTREE_FLAGS fact about the given page's subtree. It comes from prefetch_subtree_flags() if that
+    was called for this page and user, or from the page's PageSubtreeStats row if it has one (see
+    wagtail_patches.subtree_stats), or from a query over the subtree otherwise.
+    """
+    prefetched = getattr(page, '_subtree_flags', None)
+    if prefetched is not None and prefetched[0] == user.pk:
+        return prefetched[1][flag]
+    # A missing row raises RelatedObjectDoesNotExist, which is an AttributeError.
+    stats = getattr(page, 'subtree_stats', None)
+    if stats is not None:
+        return stats.get_flags(user)[flag]
+    pages = page.get_descendants(inclusive=True)
+    if flag == 'has_live':
+        return pages.live().exists()
+    elif flag == 'has_unowned':
+        return pages.exclude(owner=user).exists()
+    else:
+        return pages.exclude(live=False, owner=user).exists()
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from django.conf import settings
+from django.db import transaction
+from wagtail.wagtailcore.models import Site
+
+from core.logging import logger
+from core.utils import get_cache_version, bump_cache_version
+
+# The key in the cache under which the current version of the routing table is stored. Every process compares its own
+# table's version against this one, so a bump from any process makes all the others rebuild their tables.
+ROUTING_VERSION_KEY = 'site-routing-version'
+
+Routes = namedtuple('Routes', ['version', 'sites', 'hostnames', 'hostname_ports', 'aliases'])
+
+
+class SiteRoutingTable(object):
+    """
+    A per-process map from hostnames, (hostname, port) pairs, and alias domains to Site objects. It lets
+    match_site_to_request() find the Site for a request with dict lookups, rather than up to three database queries.
+
+    The table is built from the database the first time it's needed, and rebuilt whenever it's been invalidated, either
+    by this process (see core.signals) or by another process that bumped the version stored at ROUTING_VERSION_KEY.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = None
+
+    def build(self, version=None):
+        """
+        Loads every Site (along with its settings, root_page and features) and every alias from the database.
+        """
+        sites = {}
+        hostnames = {}
+        hostname_ports = {}
+        for site in Site.objects.select_related('settings', 'root_page', 'features'):
+            sites[site.pk] = site
+            hostname = site.hostname.lower()
+            hostnames.setdefault(hostname, []).append(site.pk)
+            hostname_ports[(hostname, site.port)] = site.pk
+
+        aliases = {
+            domain.lower(): site_pk
+            for domain, site_pk
+            in Site.objects.filter(settings__aliases__isnull=False).values_list('settings__aliases__domain', 'pk')
+        }
+
+        # Swap in the new routes all at once, so that concurrent lookups never see a half-built table.
+        self._routes = Routes(version, sites, hostnames, hostname_ports, aliases)
+        # Anything we remembered about unknown hosts was relative to the old routes, so forget it.
+        unknown_host_cache.clear()
+        logger.debug('site.routing.built', version=version, sites=len(sites), aliases=len(aliases))
+        return self._routes
+
+    def get_routes(self):
+        """
+        Returns the current Routes, rebuilding them first if this process's copy is missing or out of date.
+        """
+        # Read the version before building, so that an invalidation which happens mid-build will be noticed next time.
+        version = get_cache_version(ROUTING_VERSION_KEY)
+        routes = self._routes
+        if routes is None or routes.version != version:
+            with self._lock:
+                routes = self._routes
+                if routes is None or routes.version != version:
+                    routes = self.build(version)
+        return routes
+
+    def invalidate(self):
+        """
+        Throws away this process's routes immediately, and tells every other process to do the same once the current
+        transaction commits. Bumping the version any earlier could let another process rebuild from stale data.
+        """
+        self._routes = None
+        transaction.on_commit(lambda: bump_cache_version(ROUTING_VERSION_KEY))
+
+    @staticmethod
+    def is_root_page(page_pk):
+        """
+        Returns True if the given Page pk is the root_page of any Site. This asks the database rather than this
+        process's routes, which may not be loaded (e.g. in a Celery worker, or right after an invalidation), even though
+        every other process's routes hold the Page.
+        """
+        return Site.objects.filter(root_page_id=page_pk).exists()
+
+    def site_pks_for_path(self, path):
+        """
+        Returns the pks of every Site whose root page is the Page at the given treebeard path, or one of its ancestors.
+        """
+        return [
+            site.pk for site in self.get_routes().sites.values()
+            if site.root_page_id is not None and path.startswith(site.root_page.path)
+        ]
+
+    def match(self, hostname, port=None, routes=None):
+        """
+        Returns a list of [<match-type>, Site] for the given hostname, using the same rules as match_site_to_request().
+        Raises Site.DoesNotExist if nothing matches. Pass in routes if they've already been fetched with get_routes().
+        """
+        if routes is None:
+            routes = self.get_routes()
+        hostname = hostname.lower()
+        site_pks = routes.hostnames.get(hostname)
+        if site_pks:
+            if len(site_pks) == 1:
+                return ['hostname', routes.sites[site_pks[0]]]
+            # As there were more than one, try matching by port, too.
+            try:
+                return ['hostname', routes.sites[routes.hostname_ports[(hostname, int(port))]]]
+            except (KeyError, TypeError, ValueError):
+                raise Site.DoesNotExist()
+        try:
+            return ['alias', routes.sites[routes.aliases[hostname]]]
+        except KeyError:
+            raise Site.DoesNotExist()
+
+
+class UnknownHostCache(object):
+    """
+    A bounded, per-process record of hostnames that recently matched no Site. Scanners and spoofed Host headers tend to
+    repeat the same bogus hostnames, so remembering them lets match_site_to_request() skip straight to the 404.
+
+    Each entry records the version of the routes that failed to match the hostname, and only counts while those are
+    still the current routes, so a Site or alias created by another process makes its hostname routable here as soon as
+    that process bumps the routing version. Entries also expire after UNKNOWN_HOST_CACHE_TTL seconds, and the oldest
+    entries are evicted once there are more than UNKNOWN_HOST_CACHE_SIZE of them. A hostname is forgotten as soon as
+    this process sees a Site or alias created with that name (see core.signals), and the whole cache is cleared
+    whenever this process rebuilds its routing table.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size if max_size is not None else getattr(settings, 'UNKNOWN_HOST_CACHE_SIZE', 1000)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'UNKNOWN_HOST_CACHE_TTL', 60)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Maps hostname -> (expiry time, routes version), ordered from least to most recently added.
+        self._entries = OrderedDict()
+
+    def is_unknown(self, hostname, version):
+        """
+        Returns True if the given hostname is known not to match any Site in the given version of the routes, and
+        counts the lookup as a hit or miss.
+        """
+        hostname = hostname.lower()
+        with self._lock:
+            entry = self._entries.get(hostname)
+            if entry is not None and entry[0] > time.monotonic() and entry[1] == version:
+                self.hits += 1
+                return True
+            if entry is not None:
+                del self._entries[hostname]
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, hostname, version):
+        """
+        Remembers that the given hostname doesn't match any Site in the given version of the routes.
+        """
+        hostname = hostname.lower()
+        with self._lock:
+            self._entries.pop(hostname, None)
+            self._entries[hostname] = (time.monotonic() + self.ttl, version)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, hostname):
+        """
+        Forgets the given hostname, e.g. because a Site or alias has just been created with that name.
+        """
+        with self._lock:
+            self._entries.pop(hostname.lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        Returns a dict of this cache's hit and miss counters, and its current size.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+site_routing_table = SiteRoutingTable()
+unknown_host_cache = UnknownHostCache()
@@ -0,0 +1,104 @@
+"""
+Renames every file under one prefix of an S3 bucket to another prefix, e.g. when a Site's hostname changes.
+
+S3 can't rename objects, so each one is copied to its new key and the original is deleted. Objects are handled one
+listing page (up to 1000 keys) at a time: the page's copies run in parallel on a thread pool, then the originals which
+were copied successfully are deleted with a single delete_objects() call. Progress is checkpointed in the cache (redis)
+after every page, so a rename which is interrupted (e.g. because its worker died) carries on after the last finished
+page when it's run again, rather than starting over.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.cache import cache
+
+from core.logging import logger
+
+RENAME_CHECKPOINT_KEY = 's3-rename-checkpoint'
+RENAME_CHECKPOINT_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def get_checkpoint_key(bucket, old_prefix, new_prefix):
+    return '{}-{}-{}-{}'.format(RENAME_CHECKPOINT_KEY, bucket, old_prefix, new_prefix)
+
+
+def get_acl(new_key, new_prefix):
+    """
+    All our files get the 'public-read' ACL except for documents, which need to be given 'private'. copy_object()
+    doesn't copy the original file's ACL, so it has to be set on every copy.
+    """
+    return 'private' if new_key.startswith(new_prefix + 'documents/') else 'public-read'
+
+
+def copy_object(client, bucket, old_key, new_key, acl):
+    """
+    Copies the object at old_key to new_key. Returns None if that worked, or a description of the error if it didn't.
+    """
+    try:
+        client.copy_object(CopySource={'Bucket': bucket, 'Key': old_key}, Bucket=bucket, Key=new_key, ACL=acl)
+    except ClientError as err:
+        return str(err)
+    return None
+
+
+def rename_prefix(client, bucket, old_prefix, new_prefix, workers=None):
+    """
+    Renames every object in the given bucket whose key starts with old_prefix, so that it starts with new_prefix
+    instead. Returns a dict with the number of objects copied and deleted, and a 'failures' dict which maps each key
+    that couldn't be copied or deleted to its error. Objects which couldn't be copied are left where they were.
+    """
+    if workers is None:
+        workers = getattr(settings, 'S3_RENAME_WORKERS', 16)
+    checkpoint_key = get_checkpoint_key(bucket, old_prefix, new_prefix)
+    checkpoint = cache.get(checkpoint_key) or {'start_after': '', 'copied': 0, 'deleted': 0, 'failures': {}}
+    if checkpoint['start_after']:
+        logger.info('s3.rename.resumed', old_prefix=old_prefix, new_prefix=new_prefix, after=checkpoint['start_after'])
+
+    params = {'Bucket': bucket, 'Prefix': old_prefix}
+    if checkpoint['start_after']:
+        # Objects that were renamed already are gone, but those that failed aren't, and shouldn't be tried again.
+        params['StartAfter'] = checkpoint['start_after']
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in client.get_paginator('list_objects_v2').paginate(**params):
+            old_keys = [obj['Key'] for obj in page.get('Contents', [])]
+            if not old_keys:
+                continue
+            new_keys = [new_prefix + old_key[len(old_prefix):] for old_key in old_keys]
+            errors = executor.map(
+                lambda keys: copy_object(client, bucket, keys[0], keys[1], get_acl(keys[1], new_prefix)),
+                zip(old_keys, new_keys)
+            )
+
+            copied = []
+            for old_key, error in zip(old_keys, errors):
+                if error is None:
+                    copied.append(old_key)
+                else:
+                    checkpoint['failures'][old_key] = error
+            checkpoint['copied'] += len(copied)
+
+            if copied:
+                response = client.delete_objects(
+                    Bucket=bucket, Delete={'Objects': [{'Key': key} for key in copied], 'Quiet': True}
+                )
+                delete_errors = response.get('Errors', [])
+                for error in delete_errors:
+                    checkpoint['failures'][error['Key']] = '{}: {}'.format(error.get('Code'), error.get('Message'))
+                checkpoint['deleted'] += len(copied) - len(delete_errors)
+
+            checkpoint['start_after'] = old_keys[-1]
+            cache.set(checkpoint_key, checkpoint, RENAME_CHECKPOINT_TIMEOUT)
+            logger.info(
+                's3.rename.progress', old_prefix=old_prefix, new_prefix=new_prefix, copied=checkpoint['copied'],
+                failed=len(checkpoint['failures'])
+            )
+
+    cache.delete(checkpoint_key)
+    for key, error in sorted(checkpoint['failures'].items()):
+        logger.warning('s3.rename.failed', key=key, error=error)
+    logger.info(
+        's3.rename.complete', old_prefix=old_prefix, new_prefix=new_prefix, copied=checkpoint['copied'],
+        deleted=checkpoint['deleted'], failed=len(checkpoint['failures'])
+    )
+    return {'copied': checkpoint['copied'], 'deleted': checkpoint['deleted'], 'failures': checkpoint['failures']}
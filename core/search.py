@@ -0,0 +1,278 @@
+"""
+A tenant-aware version of Wagtail's Elasticsearch 5 search backend. Every Site shares the same indexes, so this backend
+makes sure that a search can only ever find the current Site's Pages, no matter how its queryset was built.
+
+Each Page's document gets a site_id keyword field, listing the pk of every Site that contains the Page, and every Page
+search made during a request filters on the current Site's pk in Elasticsearch's filter context (so it's cached, and
+doesn't affect scoring). With the SITE_ROUTING option enabled, each Page's document is also routed by its tenant's
+top-level page (the ancestor at depth 2, which is the homepage of most Sites), and searches pass the current Site's
+routing key, so they only touch the one shard that holds that tenant's documents rather than every shard in the index.
+
+Changing this backend's mapping or enabling SITE_ROUTING requires a full `manage.py update_index` to take effect.
+"""
+from collections import defaultdict
+from djunk.middleware import get_current_request
+from elasticsearch import NotFoundError
+from elasticsearch.helpers import bulk
+from wagtail.wagtailcore.models import Page
+from wagtail.wagtailsearch.backends import get_search_backends
+from wagtail.wagtailsearch.backends.elasticsearch5 import (
+    Elasticsearch5Index, Elasticsearch5Mapping, Elasticsearch5SearchBackend, Elasticsearch5SearchQuery,
+    Elasticsearch5SearchResults
+)
+from wagtail.wagtailsearch.index import class_is_indexed
+
+from core.logging import logger
+from core.routing import site_routing_table
+
+SITE_ID_FIELD = 'site_id'
+
+
+def get_routing_key(path):
+    """
+    Returns the routing key for the document of the Page at the given path: the path of its depth-2 ancestor. Pages
+    above depth 2 have no routing key, and are routed by their document id, like any other document.
+    """
+    if len(path) < 2 * Page.steplen:
+        return None
+    return path[:2 * Page.steplen]
+
+
+def get_site_routing_key(site):
+    """
+    Returns the routing key that searches within the given Site should use, or None if the Site's Pages might be spread
+    across several routing keys (because its root page is the ultimate root Page).
+    """
+    if site.root_page_id is None:
+        return None
+    return get_routing_key(site.root_page.path)
+
+
+def get_current_site():
+    return getattr(get_current_request(), 'site', None)
+
+
+def is_page_model(model):
+    return issubclass(model, Page)
+
+
+class SiteScopedMapping(Elasticsearch5Mapping):
+
+    def get_mapping(self):
+        mapping = super(SiteScopedMapping, self).get_mapping()
+        if is_page_model(self.model):
+            mapping[self.get_document_type()]['properties'][SITE_ID_FIELD] = dict(
+                type=self.keyword_type, include_in_all=False
+            )
+        return mapping
+
+    def get_document(self, obj):
+        doc = super(SiteScopedMapping, self).get_document(obj)
+        if is_page_model(self.model):
+            doc[SITE_ID_FIELD] = [str(site_pk) for site_pk in site_routing_table.site_pks_for_path(obj.path)]
+        return doc
+
+
+class SiteScopedIndex(Elasticsearch5Index):
+
+    def get_routing(self, item):
+        if self.backend.site_routing and isinstance(item, Page):
+            return get_routing_key(item.path)
+        return None
+
+    def add_item(self, item):
+        if not class_is_indexed(item.__class__):
+            return
+
+        mapping = self.mapping_class(item.__class__)
+        self.es.index(
+            self.name, mapping.get_document_type(), mapping.get_document(item), id=mapping.get_document_id(item),
+            routing=self.get_routing(item)
+        )
+
+    def add_items(self, model, items):
+        if not class_is_indexed(model):
+            return
+
+        mapping = self.mapping_class(model)
+        doc_type = mapping.get_document_type()
+
+        actions = []
+        for item in items:
+            action = {
+                '_index': self.name,
+                '_type': doc_type,
+                '_id': mapping.get_document_id(item),
+            }
+            routing = self.get_routing(item)
+            if routing is not None:
+                action['_routing'] = routing
+            action.update(mapping.get_document(item))
+            actions.append(action)
+
+        bulk(self.es, actions)
+
+    def delete_item(self, item):
+        if not class_is_indexed(item.__class__):
+            return
+
+        mapping = self.mapping_class(item.__class__)
+        try:
+            self.es.delete(
+                self.name, mapping.get_document_type(), mapping.get_document_id(item), routing=self.get_routing(item)
+            )
+        except NotFoundError:
+            pass  # Document doesn't exist, ignore this exception
+
+    def delete_page_documents(self, page_pks, routing):
+        """
+        Deletes the documents of the Pages with the given pks that were indexed with the given routing key, e.g.
+        because the Pages have since been moved to another tenant, where their documents have a different one.
+        """
+        self.es.delete_by_query(
+            index=self.name, routing=routing, body={'query': {'terms': {'pk': [str(pk) for pk in page_pks]}}}
+        )
+
+
+class SiteScopedSearchQuery(Elasticsearch5SearchQuery):
+    mapping_class = SiteScopedMapping
+
+    def __init__(self, *args, **kwargs):
+        super(SiteScopedSearchQuery, self).__init__(*args, **kwargs)
+        # Searches made outside of a request (e.g. from manage.py shell) aren't scoped to any Site.
+        self.site = get_current_site() if is_page_model(self.queryset.model) else None
+
+    def get_filters(self):
+        filters = super(SiteScopedSearchQuery, self).get_filters()
+        if self.site is not None:
+            filters.append({'term': {SITE_ID_FIELD: str(self.site.pk)}})
+        return filters
+
+
+class SiteScopedSearchResults(Elasticsearch5SearchResults):
+
+    def get_routing(self):
+        if self.backend.site_routing and self.query.site is not None:
+            return get_site_routing_key(self.query.site)
+        return None
+
+    def _do_search(self):
+        # This is ElasticsearchSearchResults._do_search(), plus the routing param.
+        params = dict(
+            index=self.backend.get_index_for_model(self.query.queryset.model).name,
+            body=self._get_es_body(),
+            _source=False,
+            from_=self.start,
+            routing=self.get_routing(),
+        )
+
+        params[self.fields_param_name] = 'pk'
+
+        if self.stop is not None:
+            params['size'] = self.stop - self.start
+
+        hits = self.backend.es.search(**params)
+
+        pks = [hit['fields']['pk'][0] for hit in hits['hits']['hits']]
+        scores = {str(hit['fields']['pk'][0]): hit['_score'] for hit in hits['hits']['hits']}
+
+        results = dict((str(pk), None) for pk in pks)
+
+        queryset = self.query.queryset.filter(pk__in=pks)
+        for obj in queryset:
+            results[str(obj.pk)] = obj
+
+            if self._score_field:
+                setattr(obj, self._score_field, scores.get(str(obj.pk)))
+
+        return [results[str(pk)] for pk in pks if results[str(pk)]]
+
+    def _do_count(self):
+        # This is ElasticsearchSearchResults._do_count(), plus the routing param.
+        hit_count = self.backend.es.count(
+            index=self.backend.get_index_for_model(self.query.queryset.model).name,
+            body=self._get_es_body(for_count=True),
+            routing=self.get_routing(),
+        )['count']
+
+        hit_count -= self.start
+        if self.stop is not None:
+            hit_count = min(hit_count, self.stop - self.start)
+
+        return max(hit_count, 0)
+
+
+class SiteScopedSearchBackend(Elasticsearch5SearchBackend):
+    mapping_class = SiteScopedMapping
+    index_class = SiteScopedIndex
+    query_class = SiteScopedSearchQuery
+    results_class = SiteScopedSearchResults
+
+    def __init__(self, params):
+        # This must be popped before the parent constructor passes the leftover params to Elasticsearch.
+        self.site_routing = params.pop('SITE_ROUTING', False)
+        super(SiteScopedSearchBackend, self).__init__(params)
+
+
+SearchBackend = SiteScopedSearchBackend
+
+
+def get_page_search_scope(path):
+    """
+    Returns the facts about the Page at the given path that its search document depends on, beyond its own fields.
+    """
+    return get_routing_key(path), site_routing_table.site_pks_for_path(path)
+
+
+def page_subtree_chunks(page, chunk_size):
+    """
+    Yields the given Page and its descendants as specific Pages, in chunks of up to chunk_size, fetching each chunk
+    after the last one's greatest pk (like `manage.py update_index` does), so that a whole Site is never in memory.
+    """
+    subtree = Page.objects.descendant_of(page, inclusive=True).order_by('pk')
+    last_pk = None
+    while True:
+        chunk = subtree if last_pk is None else subtree.filter(pk__gt=last_pk)
+        chunk = list(chunk.specific()[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def reindex_page_subtree(page_pk, old_routing=None, chunk_size=1000):
+    """
+    Reindexes the Page with the given pk and all of its descendants in every auto-updated search backend, chunk_size
+    Pages at a time. Pass old_routing to also delete the documents that were indexed under that routing key.
+    """
+    page = Page.objects.get(pk=page_pk)
+    backends = [
+        (backend, old_routing is not None and getattr(backend, 'site_routing', False))
+        for backend in get_search_backends(with_auto_update=True)
+    ]
+    count = 0
+    for chunk in page_subtree_chunks(page, chunk_size):
+        pages_by_model = defaultdict(list)
+        for descendant in chunk:
+            pages_by_model[type(descendant)].append(descendant)
+
+        for backend, delete_old_documents in backends:
+            if delete_old_documents:
+                backend.get_index_for_model(Page).delete_page_documents(
+                    [descendant.pk for descendant in chunk], old_routing
+                )
+            for model, model_pages in pages_by_model.items():
+                backend.add_bulk(model, model_pages)
+        count += len(chunk)
+    logger.info('search.subtree.reindexed', page=page_pk, pages=count)
+
+
+def reindex_moved_page(page_pk, old_path):
+    """
+    Reindexes the subtree of a Page that was moved from old_path, if the move changed its tenant or its Sites. Wagtail
+    only reindexes the moved Page itself, and leaves its old document behind if its routing key changed.
+    """
+    new_path = Page.objects.filter(pk=page_pk).values_list('path', flat=True).get()
+    old_scope = get_page_search_scope(old_path)
+    if get_page_search_scope(new_path) != old_scope:
+        reindex_page_subtree(page_pk, old_routing=old_scope[0])
@@ -0,0 +1,337 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from djunk.middleware import get_current_request
+from wagtail.contrib.settings.models import BaseSetting
+from wagtail.wagtailcore.models import Site, Page, Collection, GroupPagePermission, PageViewRestriction
+from wagtail.wagtailcore.signals import page_published, page_unpublished
+from wagtail.wagtaildocs.models import get_document_model
+from wagtail.wagtailsnippets.models import get_snippet_models
+
+from core.cache_tags import invalidate_tags, page_tag, settings_tag, snippet_tag
+from core.documents import refresh_document_metadata, forget_document_metadata
+from core.menus import update_menu_trees_for_page, forget_menu_tree
+from core.page_cache import invalidate_site_page_cache
+from core.permissions import forget_current_user_page_permission_index, invalidate_page_permission_indexes
+from core.routing import site_routing_table, unknown_host_cache
+from core.sitemap import invalidate_site_sitemap, invalidate_sitemaps_for_paths
+from core.tasks import reindex_page_subtree
+from core.tenants import tenant_snapshots
+from core.utils import (
+    get_alias_model, get_installed_site_settings_class, bump_cache_versions_on_commit,
+    get_user_site_membership_version_key, SITE_MEMBERSHIP_VERSION_KEY
+)
+
+
+def get_site_routing_models():
+    """
+    Returns the models whose rows are baked into the site routing table: Site itself, plus the settings, aliases, and
+    features that match_site_to_request() pre-selects. Models belonging to apps that aren't installed are skipped.
+    """
+    models = [Site, get_installed_site_settings_class(), get_alias_model()]
+    try:
+        models.append(Site._meta.get_field('features').related_model)
+    except FieldDoesNotExist:
+        pass
+    return [model for model in models if model is not None]
+
+
+# noinspection PyUnusedLocal
+def invalidate_site_routing(sender, **kwargs):
+    """
+    Rebuilds the site routing table whenever a Site, or anything it pre-selects, is saved or deleted.
+    """
+    site_routing_table.invalidate()
+
+
+# noinspection PyUnusedLocal
+def invalidate_site_routing_for_root_page(sender, instance, **kwargs):
+    """
+    The routing table holds each Site's root_page, so saving one of those Pages needs to rebuild the table. Page
+    subclasses send post_save with themselves as the sender, so we can't filter by sender when connecting this.
+    """
+    if isinstance(instance, Page) and site_routing_table.is_root_page(instance.pk):
+        site_routing_table.invalidate()
+        tenant_snapshots.invalidate()
+
+
+# noinspection PyUnusedLocal
+def invalidate_tenant_snapshots(sender, **kwargs):
+    """
+    Throws away every TenantSnapshot whenever a Site, or anything a snapshot is built from, is saved or deleted.
+    """
+    tenant_snapshots.invalidate()
+
+
+# noinspection PyUnusedLocal
+def forget_unknown_host(sender, instance, **kwargs):
+    """
+    Removes a newly saved Site's hostname, or a newly saved alias's domain, from the unknown host cache, so that this
+    process doesn't keep answering 404 for it until the entry expires.
+    """
+    hostname = getattr(instance, 'hostname', None) or getattr(instance, 'domain', None)
+    if hostname:
+        unknown_host_cache.discard(hostname)
+
+
+def forget_current_request_site_membership():
+    """
+    Throws away the site membership verdicts memoized on the current request, if there is one.
+    """
+    request = get_current_request()
+    if request is not None and hasattr(request, '_site_membership'):
+        request._site_membership = {}
+
+
+# noinspection PyUnusedLocal
+def invalidate_user_site_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidates the memoized site membership verdicts of every User whose Groups have just changed, once the change is
+    committed.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        # instance is a User.
+        bump_cache_versions_on_commit(get_user_site_membership_version_key(instance.pk))
+    elif pk_set:
+        # instance is a Group, and pk_set holds the pks of the Users that were added to or removed from it.
+        bump_cache_versions_on_commit(*[get_user_site_membership_version_key(user_pk) for user_pk in pk_set])
+    else:
+        # A Group was cleared of all its Users, and we weren't told which ones they were.
+        bump_cache_versions_on_commit(SITE_MEMBERSHIP_VERSION_KEY)
+    forget_current_request_site_membership()
+    # Page permission indexes are stored under the same versions (see core.permissions).
+    forget_current_user_page_permission_index()
+
+
+# noinspection PyUnusedLocal
+def invalidate_all_site_membership(sender, **kwargs):
+    """
+    Renaming or deleting a Group can change any User's membership in any Site, so invalidate every memoized verdict.
+    """
+    bump_cache_versions_on_commit(SITE_MEMBERSHIP_VERSION_KEY)
+    forget_current_request_site_membership()
+    forget_current_user_page_permission_index()
+
+
+def invalidate_page_cache_for_page_sites(page):
+    """
+    Invalidates the page cache of every Site that contains the given Page.
+    """
+    for site_pk in site_routing_table.site_pks_for_path(page.path):
+        invalidate_site_page_cache(site_pk)
+
+
+# noinspection PyUnusedLocal
+def remember_page_menu_state(sender, instance, update_fields=None, **kwargs):
+    """
+    Records whether a Page was shown in menus before this save, so that invalidate_cache_tags_for_published_page() can
+    tell if publishing it removed it from them. Saves which can't change that (e.g. saving a draft revision) are
+    skipped, to save the query.
+    """
+    if not isinstance(instance, Page) or instance.pk is None:
+        return
+    if update_fields is not None and not {'live', 'show_in_menus'} & set(update_fields):
+        return
+    row = Page.objects.filter(pk=instance.pk).values_list('live', 'show_in_menus').first()
+    instance._was_in_menus = row is not None and all(row)
+
+
+# noinspection PyUnusedLocal
+def invalidate_cache_tags_for_published_page(sender, instance, **kwargs):
+    """
+    Evicts the cached copies of a newly published Page, and of its parent, which may list it. Pages shown in menus
+    appear on every page of their Sites, so publishing one which is, or was until now, shown in menus invalidates the
+    Sites' whole page caches.
+    """
+    if instance.show_in_menus or instance.__dict__.pop('_was_in_menus', False):
+        invalidate_page_cache_for_page_sites(instance)
+    else:
+        parent = instance.get_parent()
+        invalidate_tags(page_tag(instance.pk), page_tag(parent.pk) if parent else None)
+
+
+# noinspection PyUnusedLocal
+def invalidate_page_cache_for_removed_page(sender, instance, **kwargs):
+    """
+    Invalidates the page cache of every Site that contains a Page which was just unpublished or deleted, since any of
+    that Site's cached pages might link to it. Page subclasses send post_delete with themselves as the sender, so we
+    can't filter by sender when connecting this.
+    """
+    if isinstance(instance, Page):
+        invalidate_page_cache_for_page_sites(instance)
+
+
+# noinspection PyUnusedLocal
+def invalidate_cache_tags_for_instance(sender, instance, **kwargs):
+    """
+    Invalidates the page cache of a Site which was just saved or deleted, and evicts whatever was tagged with a setting
+    or snippet which was just saved or deleted.
+    """
+    if isinstance(instance, Site):
+        invalidate_site_page_cache(instance.pk)
+        invalidate_site_sitemap(instance.pk)
+    elif isinstance(instance, BaseSetting):
+        invalidate_tags(settings_tag(type(instance), instance.site_id))
+    elif type(instance) in get_snippet_models():
+        invalidate_tags(snippet_tag(instance))
+
+
+# noinspection PyUnusedLocal
+def invalidate_sitemaps_for_page(sender, instance, **kwargs):
+    """
+    Makes the cached sitemap of every Site that contains the given Page stale.
+    """
+    if isinstance(instance, Page):
+        invalidate_sitemaps_for_paths(instance.path)
+
+
+# noinspection PyUnusedLocal
+def invalidate_sitemaps_for_view_restriction(sender, instance, **kwargs):
+    """
+    Sitemaps only list public Pages, so adding or removing a view restriction changes the sitemaps of the restricted
+    Page's Sites.
+    """
+    invalidate_sitemaps_for_paths(instance.page.path)
+
+
+# noinspection PyUnusedLocal
+def update_menu_trees_for_changed_page(sender, instance, **kwargs):
+    """
+    Updates the cached menu tree of every Site that contains a Page which was just published, unpublished or deleted
+    (see core.menus). Other saves, like the one that stores a draft revision, don't change what the menus show.
+    """
+    if isinstance(instance, Page):
+        # Deleting an instance sets its pk to None, so remember it now.
+        page_pk, path = instance.pk, instance.path
+        transaction.on_commit(lambda: update_menu_trees_for_page(page_pk, path))
+
+
+# noinspection PyUnusedLocal
+def forget_site_menu_tree(sender, instance, **kwargs):
+    """
+    A Site's menu tree is built from its root page, so saving a Site might change its whole menu.
+    """
+    site_pk = instance.pk
+    transaction.on_commit(lambda: forget_menu_tree(site_pk))
+
+
+# noinspection PyUnusedLocal
+def remember_site_root_page(sender, instance, **kwargs):
+    """
+    Records the root_page_id that a Site had before this save, so that reindex_site_pages() can tell if it changed.
+    """
+    if instance.pk is not None:
+        instance._old_root_page_id = Site.objects.filter(pk=instance.pk).values_list('root_page_id', flat=True).first()
+
+
+# noinspection PyUnusedLocal
+def reindex_site_pages(sender, instance, **kwargs):
+    """
+    Every Page's search document lists the Sites that contain it (see core.search), so when a Site gets a new root page,
+    the subtrees of both its new and old root pages need to be reindexed. That happens in a celery task, as a Site can
+    contain tens of thousands of Pages.
+    """
+    old_root_page_id = instance.__dict__.pop('_old_root_page_id', None)
+    if instance.root_page_id == old_root_page_id:
+        return
+    for page_pk in (instance.root_page_id, old_root_page_id):
+        if page_pk is not None:
+            transaction.on_commit(lambda page_pk=page_pk: reindex_page_subtree.apply_async(args=[page_pk]))
+
+
+# noinspection PyUnusedLocal
+def cache_saved_document_metadata(sender, instance, **kwargs):
+    """
+    Stores a Document's metadata in the cache as soon as it's uploaded or edited, so that document_serve never needs to
+    load it (see core.documents).
+    """
+    transaction.on_commit(lambda: refresh_document_metadata(instance))
+
+
+# noinspection PyUnusedLocal
+def forget_deleted_document_metadata(sender, instance, **kwargs):
+    # Deleting an instance sets its pk to None, so remember it now.
+    document_id = instance.pk
+    transaction.on_commit(lambda: forget_document_metadata(document_id))
+
+
+# noinspection PyUnusedLocal
+def invalidate_page_permissions(sender, **kwargs):
+    """
+    Makes every User's cached page permission index stale when any GroupPagePermission changes (see core.permissions).
+    Changes to a User's Groups are covered by the site membership versions that the index is also stored under, which
+    invalidate_user_site_membership() bumps once the change commits.
+    """
+    invalidate_page_permission_indexes()
+
+
+def connect_signals():
+    """
+    Connects all of core's signal handlers. Called from CoreConfig.ready(), once all the models have been loaded.
+    """
+    for model in get_site_routing_models():
+        for signal in (post_save, post_delete):
+            signal.connect(
+                invalidate_site_routing, sender=model, dispatch_uid='site_routing_{}'.format(model._meta.label_lower)
+            )
+    post_save.connect(invalidate_site_routing_for_root_page, dispatch_uid='site_routing_root_page')
+
+    for model in get_site_routing_models() + [Collection, Group]:
+        for signal in (post_save, post_delete):
+            signal.connect(
+                invalidate_tenant_snapshots, sender=model, dispatch_uid='tenant_{}'.format(model._meta.label_lower)
+            )
+
+    for model in (Site, get_alias_model()):
+        if model is not None:
+            post_save.connect(
+                forget_unknown_host, sender=model, dispatch_uid='unknown_host_{}'.format(model._meta.label_lower)
+            )
+
+    m2m_changed.connect(
+        invalidate_user_site_membership, sender=get_user_model().groups.through, dispatch_uid='site_membership_user'
+    )
+    post_save.connect(invalidate_all_site_membership, sender=Group, dispatch_uid='site_membership_group')
+    post_delete.connect(invalidate_all_site_membership, sender=Group, dispatch_uid='site_membership_group')
+
+    # Page subclasses send these signals with themselves as the sender, and BaseSetting and the snippet models are many,
+    # so none of these can be filtered by sender.
+    pre_save.connect(remember_page_menu_state, dispatch_uid='page_cache_page_pre_save')
+    page_published.connect(invalidate_cache_tags_for_published_page, dispatch_uid='page_cache_published')
+    page_unpublished.connect(invalidate_page_cache_for_removed_page, dispatch_uid='page_cache_unpublished')
+    post_delete.connect(invalidate_page_cache_for_removed_page, dispatch_uid='page_cache_page_deleted')
+    post_save.connect(invalidate_cache_tags_for_instance, dispatch_uid='cache_tags_saved')
+    post_delete.connect(invalidate_cache_tags_for_instance, dispatch_uid='cache_tags_deleted')
+
+    # Page subclasses send these signals with themselves as the sender, so they can't be filtered by sender. Moves are
+    # handled by the Page.move() monkey patch.
+    page_published.connect(update_menu_trees_for_changed_page, dispatch_uid='menu_tree_page_published')
+    page_unpublished.connect(update_menu_trees_for_changed_page, dispatch_uid='menu_tree_page_unpublished')
+    post_delete.connect(update_menu_trees_for_changed_page, dispatch_uid='menu_tree_page_deleted')
+    post_save.connect(forget_site_menu_tree, sender=Site, dispatch_uid='menu_tree_site_saved')
+    post_delete.connect(forget_site_menu_tree, sender=Site, dispatch_uid='menu_tree_site_deleted')
+
+    page_published.connect(invalidate_sitemaps_for_page, dispatch_uid='sitemap_published')
+    page_unpublished.connect(invalidate_sitemaps_for_page, dispatch_uid='sitemap_unpublished')
+    post_delete.connect(invalidate_sitemaps_for_page, dispatch_uid='sitemap_page_deleted')
+    for signal in (post_save, post_delete):
+        signal.connect(
+            invalidate_sitemaps_for_view_restriction, sender=PageViewRestriction,
+            dispatch_uid='sitemap_view_restriction'
+        )
+
+    pre_save.connect(remember_site_root_page, sender=Site, dispatch_uid='search_site_pre_save')
+    post_save.connect(reindex_site_pages, sender=Site, dispatch_uid='search_site_saved')
+
+    Document = get_document_model()
+    post_save.connect(cache_saved_document_metadata, sender=Document, dispatch_uid='document_metadata_saved')
+    post_delete.connect(forget_deleted_document_metadata, sender=Document, dispatch_uid='document_metadata_deleted')
+
+    post_save.connect(invalidate_page_permissions, sender=GroupPagePermission, dispatch_uid='page_permissions_saved')
+    post_delete.connect(
+        invalidate_page_permissions, sender=GroupPagePermission, dispatch_uid='page_permissions_deleted'
+    )
@@ -0,0 +1,147 @@
+"""
+Generates each Site's sitemap as a stream of XML, so that tenants with tens of thousands of pages never need all of them
+in memory at once.
+
+Pages are read in path order, in chunks of SITEMAP_CHUNK_SIZE, with keyset pagination (each chunk starts after the last
+path of the previous one) rather than OFFSET, so every chunk costs the same single indexed query. Each chunk's rendered
+XML is cached until the Site's sitemap version is bumped, which happens whenever one of its pages is published,
+unpublished, moved or deleted, or has its view restrictions changed (see core.signals and the Page.move() monkey
+patch). Sites with more than SITEMAP_MAX_URLS pages get a sitemap index which points to several sitemap sections, as
+the sitemap protocol requires.
+"""
+from xml.sax.saxutils import escape
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from wagtail.wagtailcore.models import Page
+
+from core.routing import site_routing_table
+from core.utils import get_cache_version, bump_cache_version
+
+SITEMAP_VERSION_KEY = 'sitemap-version'
+# The sitemap protocol's limit on the number of URLs in one sitemap file.
+SITEMAP_MAX_URLS = 50000
+SITEMAP_CHUNK_SIZE = 2000
+SITEMAP_CACHE_TIMEOUT = 60 * 60 * 24
+
+SITEMAP_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+)
+SITEMAP_FOOTER = '</urlset>\n'
+SITEMAP_INDEX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+)
+SITEMAP_INDEX_FOOTER = '</sitemapindex>\n'
+
+
+def get_site_sitemap_version_key(site_pk):
+    return '{}-{}'.format(SITEMAP_VERSION_KEY, site_pk)
+
+
+def invalidate_site_sitemap(site_pk):
+    """
+    Makes every cached sitemap chunk for the given Site stale, once the current transaction commits.
+    """
+    transaction.on_commit(lambda: bump_cache_version(get_site_sitemap_version_key(site_pk)))
+
+
+def invalidate_sitemaps_for_paths(*paths):
+    """
+    Makes the cached sitemap of every Site that contains any of the given Page paths stale.
+    """
+    site_pks = set()
+    for path in paths:
+        site_pks.update(site_routing_table.site_pks_for_path(path))
+    for site_pk in site_pks:
+        invalidate_site_sitemap(site_pk)
+
+
+def get_sitemap_pages(site):
+    """
+    Returns a queryset of every Page that belongs in the given Site's sitemap, ordered by path.
+    """
+    return Page.objects.descendant_of(site.root_page, inclusive=True).live().public().order_by('path')
+
+
+class SiteSitemap(object):
+    """
+    The sitemap of a single Site, as of the Site's current sitemap version.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.version = get_cache_version(get_site_sitemap_version_key(site.pk))
+        self.root_url = site.root_url
+        self.root_url_path = site.root_page.url_path
+        self.append_slash = getattr(settings, 'WAGTAIL_APPEND_SLASH', True)
+
+    def make_key(self, *parts):
+        return ':'.join(['sitemap', str(self.site.pk), str(self.version)] + [str(part) for part in parts])
+
+    def get_section_starts(self):
+        """
+        Returns a list with one entry per sitemap section: the path after which that section's pages begin. Only the
+        first page of each section is looked up, so this costs one COUNT, plus one query per section after the first.
+        """
+        key = self.make_key('sections')
+        starts = cache.get(key)
+        if starts is None:
+            paths = get_sitemap_pages(self.site).values_list('path', flat=True)
+            count = paths.count()
+            starts = [''] + [paths[end - 1] for end in range(SITEMAP_MAX_URLS, count, SITEMAP_MAX_URLS)]
+            cache.set(key, starts, SITEMAP_CACHE_TIMEOUT)
+        return starts
+
+    def get_chunk(self, section, index, start_after):
+        """
+        Returns the rendered XML of one chunk of the given section, and the path of the chunk's last page (or None if
+        the section ends with this chunk).
+        """
+        key = self.make_key(section, index)
+        chunk = cache.get(key)
+        if chunk is None:
+            pages = get_sitemap_pages(self.site).filter(path__gt=start_after)
+            rows = list(pages.values_list('path', 'url_path', 'last_published_at')[:SITEMAP_CHUNK_SIZE])
+            xml = ''.join(self.render_url(url_path, last_published_at) for path, url_path, last_published_at in rows)
+            last_path = rows[-1][0] if len(rows) == SITEMAP_CHUNK_SIZE else None
+            chunk = (xml, last_path)
+            cache.set(key, chunk, SITEMAP_CACHE_TIMEOUT)
+        return chunk
+
+    def render_url(self, url_path, last_published_at):
+        path = url_path[len(self.root_url_path) - 1:]
+        if not self.append_slash and path != '/':
+            # Like Page.get_url_parts(), so that no URL in the sitemap gets redirected by SlashMiddleware.
+            path = path.rstrip('/')
+        loc = self.root_url + path
+        if last_published_at is None:
+            return '<url><loc>{}</loc></url>\n'.format(escape(loc))
+        return '<url><loc>{}</loc><lastmod>{}</lastmod></url>\n'.format(
+            escape(loc), last_published_at.date().isoformat()
+        )
+
+    def stream_section(self, section):
+        """
+        Yields the XML of the given section's sitemap, one chunk at a time.
+        """
+        starts = self.get_section_starts()
+        start_after = starts[section]
+        end_after = starts[section + 1] if section + 1 < len(starts) else None
+        yield SITEMAP_HEADER
+        for index in range(SITEMAP_MAX_URLS // SITEMAP_CHUNK_SIZE):
+            xml, last_path = self.get_chunk(section, index, start_after)
+            yield xml
+            if last_path is None or last_path == end_after:
+                break
+            start_after = last_path
+        yield SITEMAP_FOOTER
+
+    def stream_index(self, section_url):
+        """
+        Yields the XML of a sitemap index, which lists the URL of every section. section_url is called with each
+        section's number to get its URL.
+        """
+        yield SITEMAP_INDEX_HEADER
+        for section in range(len(self.get_section_starts())):
+            yield '<sitemap><loc>{}</loc></sitemap>\n'.format(escape(self.root_url + section_url(section)))
+        yield SITEMAP_INDEX_FOOTER
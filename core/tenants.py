@@ -0,0 +1,100 @@
+import threading
+from collections import namedtuple
+from django.contrib.auth.models import Group
+from django.db import transaction
+from djunk.middleware import get_current_request
+from wagtail.wagtailcore.models import Site, Collection
+
+from core.utils import get_cache_version, bump_cache_version
+
+# Bumped whenever any tenant's snapshot might be out of date, which makes every process throw away its snapshots.
+TENANT_SNAPSHOT_VERSION_KEY = 'tenant-snapshot-version'
+
+TenantSnapshot = namedtuple('TenantSnapshot', [
+    'site_pk', 'hostname', 'collection_id', 'admins_group_id', 'editors_group_id', 'alias_domains', 'root_page_id',
+    'root_page_path', 'settings_pk',
+])
+
+
+def build_tenant_snapshot(site):
+    """
+    Gathers the facts about the given Site that the rest of the project would otherwise re-derive from its hostname.
+    Any of the ids may be None if the related object doesn't exist (e.g. for Sites not made by the Site Creator).
+    """
+    group_names = {'{} Admins'.format(site.hostname): 'admins', '{} Editors'.format(site.hostname): 'editors'}
+    group_ids = {
+        group_names[name]: pk for name, pk in Group.objects.filter(name__in=group_names).values_list('name', 'pk')
+    }
+    collection_id = Collection.objects.filter(name=site.hostname).values_list('pk', flat=True).first()
+
+    # This is a LEFT JOIN, so a Site with settings but no aliases gives one row with domain=None, and a Site without
+    # settings gives one row of (None, None).
+    settings_pk = None
+    alias_domains = []
+    for pk, domain in Site.objects.filter(pk=site.pk).values_list('settings__pk', 'settings__aliases__domain'):
+        settings_pk = pk
+        if domain is not None:
+            alias_domains.append(domain)
+
+    return TenantSnapshot(
+        site_pk=site.pk,
+        hostname=site.hostname,
+        collection_id=collection_id,
+        admins_group_id=group_ids.get('admins'),
+        editors_group_id=group_ids.get('editors'),
+        alias_domains=tuple(alias_domains),
+        root_page_id=site.root_page_id,
+        root_page_path=site.root_page.path,
+        settings_pk=settings_pk,
+    )
+
+
+class TenantSnapshotStore(object):
+    """
+    A per-process cache of TenantSnapshots, keyed by Site pk. Snapshots are built the first time they're needed, and
+    all of them are thrown away when this process invalidates them (see core.signals), or when another process bumps
+    the version stored at TENANT_SNAPSHOT_VERSION_KEY.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._snapshots = {}
+
+    def get(self, site):
+        version = get_cache_version(TENANT_SNAPSHOT_VERSION_KEY)
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._snapshots = {}
+                    self._version = version
+
+        # Hold on to the dict we started with, so that a snapshot built across an invalidation gets thrown away with it.
+        snapshots = self._snapshots
+        snapshot = snapshots.get(site.pk)
+        if snapshot is None or snapshot.hostname != site.hostname:
+            snapshot = snapshots[site.pk] = build_tenant_snapshot(site)
+        return snapshot
+
+    def invalidate(self):
+        """
+        Throws away this process's snapshots immediately, and tells every other process to do the same once the
+        current transaction commits.
+        """
+        self._snapshots = {}
+        transaction.on_commit(lambda: bump_cache_version(TENANT_SNAPSHOT_VERSION_KEY))
+
+
+tenant_snapshots = TenantSnapshotStore()
+
+
+def get_tenant_snapshot(site):
+    """
+    Returns the TenantSnapshot for the given Site. If it's the current request's Site, the snapshot that
+    MultitenantSiteMiddleware attached to the request is re-used, rather than checking the version again.
+    """
+    request = get_current_request()
+    tenant = getattr(request, 'tenant', None)
+    if tenant is not None and tenant.site_pk == site.pk:
+        return tenant
+    return tenant_snapshots.get(site)
@@ -0,0 +1,17 @@
+from django.test import SimpleTestCase
+
+from core.campus import CampusNetworkMatcher
+
+
+class CampusNetworkMatcherTest(SimpleTestCase):
+
+    def test_campus_network_matcher_merges_networks_and_handles_ipv6(self):
+        matcher = CampusNetworkMatcher(
+            ['10.0.0.0/8', '10.128.0.0/9', '192.168.1.0/24', '192.168.2.0/24', '2001:db8::/32']
+        )
+        self.assertEqual(len(matcher.starts[4]), 2)
+        self.assertIn('192.168.2.255', matcher)
+        self.assertIn('::ffff:10.0.0.1', matcher)
+        self.assertIn('2001:db8::1', matcher)
+        self.assertNotIn('192.168.3.0', matcher)
+        self.assertNotIn('not-an-ip', matcher)
@@ -0,0 +1,133 @@
+import shutil
+import tempfile
+from unittest import skipUnless
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, RequestFactory
+from mock import patch
+from wagtail.wagtaildocs.models import get_document_model
+
+from core.documents import (
+    StoredFile, get_cached_document, get_document_metadata, get_document_metadata_key, parse_range_header,
+    serve_document_file
+)
+from core.tests.transactions import run_on_commit_callbacks
+from core.utils import Stuff, update_db_for_hostname_change
+try:
+    # moto provides a local stand-in for S3.
+    import boto3
+    try:
+        from moto import mock_s3
+    except ImportError:
+        # moto 5 replaced its per-service mocks with a single one.
+        from moto import mock_aws as mock_s3
+except ImportError:
+    mock_s3 = None
+try:
+    from storages.backends.s3boto3 import S3Boto3Storage
+except ImportError:
+    S3Boto3Storage = None
+
+
+class DocumentServingTest(SimpleTestCase):
+
+    def test_range_header_parsing_merges_ranges_and_detects_unsatisfiable_ones(self):
+        self.assertEqual(parse_range_header('bytes=0-9,20-29,5-12', 1000), [(0, 12), (20, 29)])
+        self.assertEqual(parse_range_header('bytes=-10,990-', 1000), [(990, 999)])
+        self.assertEqual(parse_range_header('bytes=2000-', 1000), [])
+        self.assertIsNone(parse_range_header('bytes=10-5', 1000))
+        self.assertIsNone(parse_range_header('items=0-9', 1000))
+
+    def test_local_documents_serve_every_range_of_a_multipart_response(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        storage = FileSystemStorage(location=location)
+        field_file = Stuff(storage=storage, name=storage.save('documents/notes.txt', ContentFile(b'abcdefghij')))
+        request = RequestFactory().get('/', HTTP_RANGE='bytes=0-1,4-5,8-9')
+
+        response = serve_document_file(request, field_file, 'notes.txt', mode='proxy')
+        self.assertEqual(response.status_code, 206)
+        content = b''.join(response.streaming_content)
+        for part in (b'\r\n\r\nab\r\n', b'\r\n\r\nef\r\n', b'\r\n\r\nij\r\n'):
+            self.assertIn(part, content)
+        self.assertEqual(len(content), int(response['Content-Length']))
+
+        stored_file = response._closable_objects[-1]
+        self.assertFalse(stored_file.file.closed)
+        response.close()
+        self.assertTrue(stored_file.file.closed)
+
+    @skipUnless(mock_s3 and S3Boto3Storage, 'moto or django-storages is not installed')
+    def test_s3_documents_can_be_proxied_or_handed_off(self):
+        with mock_s3():
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='test-documents')
+            storage = S3Boto3Storage(bucket_name='test-documents', default_acl='private')
+            field_file = Stuff(storage=storage, name=storage.save('documents/report.pdf', ContentFile(b'%PDF-1.4')))
+            request = RequestFactory().get('/', HTTP_RANGE='bytes=0-3')
+
+            response = serve_document_file(request, field_file, 'report.pdf', mode='proxy')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), b'%PDF')
+
+            response = serve_document_file(request, field_file, 'report.pdf', mode='redirect')
+            self.assertEqual(response.status_code, 302)
+            self.assertIn('response-content-disposition=attachment', response.url)
+
+            response = serve_document_file(request, field_file, 'report.pdf', mode='accel')
+            self.assertTrue(response['X-Accel-Redirect'].startswith('/protected-s3/'))
+            self.assertIn('test-documents', response['X-Accel-Redirect'])
+            self.assertEqual(response['Content-Disposition'], 'attachment; filename=report.pdf')
+
+
+class DocumentMetadataTest(TestCase):
+
+    def setUp(self):
+        with run_on_commit_callbacks():
+            self.doc = get_document_model().objects.create(title='Notes', file=ContentFile(b'notes', name='notes.txt'))
+
+    def get_cached_metadata(self):
+        return cache.get(get_document_metadata_key(self.doc.pk))
+
+    def test_cached_document_lookup_returns_none_for_missing_documents(self):
+        self.assertIsNone(get_cached_document('999999'))
+
+    def test_saving_a_document_caches_its_new_access_flags(self):
+        self.assertFalse(self.get_cached_metadata().login_required)
+
+        with run_on_commit_callbacks():
+            self.doc.on_campus_only = True
+            self.doc.login_required = True
+            self.doc.save()
+        metadata = self.get_cached_metadata()
+        self.assertTrue(metadata.on_campus_only)
+        self.assertTrue(metadata.login_required)
+        self.assertTrue(get_cached_document(self.doc.pk).login_required)
+
+    def test_cache_misses_never_replace_the_record_of_a_document_saved_meanwhile(self):
+        read_metadata = StoredFile.read_metadata
+        saved = []
+
+        def save_document_while_reading_metadata(stored_file):
+            # Stands in for another request saving the Document during this request's HEAD request to S3.
+            if not saved:
+                saved.append(True)
+                with run_on_commit_callbacks():
+                    doc = get_document_model().objects.get(pk=self.doc.pk)
+                    doc.login_required = True
+                    doc.save()
+            return read_metadata(stored_file)
+
+        cache.delete(get_document_metadata_key(self.doc.pk))
+        with patch.object(StoredFile, 'read_metadata', autospec=True, side_effect=save_document_while_reading_metadata):
+            self.assertFalse(get_document_metadata(self.doc.pk).login_required)
+        self.assertTrue(self.get_cached_metadata().login_required)
+
+    def test_hostname_changes_forget_the_metadata_of_renamed_documents(self):
+        get_document_model().objects.filter(pk=self.doc.pk).update(file='old.oursites.com/documents/notes.txt')
+        get_document_metadata(self.doc.pk)
+        self.assertIsNotNone(self.get_cached_metadata())
+
+        with run_on_commit_callbacks():
+            update_db_for_hostname_change('old.oursites.com', 'new.oursites.com')
+        self.assertIsNone(self.get_cached_metadata())
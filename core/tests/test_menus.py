@@ -0,0 +1,62 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from wagtail.wagtailcore.models import Page
+
+from core.menus import (
+    build_menu_tree, forget_menu_tree, get_menu_pages, get_menu_tree_key, get_menu_tree_version_key, MenuPage
+)
+from core.tests.transactions import run_on_commit_callbacks
+from core.tests.utils import MultitenantSiteTestingMixin
+from core.utils import get_cache_version
+
+
+class MenuTreeTest(TestCase, MultitenantSiteTestingMixin):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.set_up_test_sites_and_users()
+
+    def get_menu_titles(self):
+        return [menu_page.title for menu_page in get_menu_pages(self.wagtail_site)]
+
+    @override_settings(WAGTAIL_APPEND_SLASH=False)
+    def test_menu_page_urls_have_no_trailing_slash(self):
+        self.assertEqual(MenuPage((1, '000100010001', 3, 'About', '/home/about/', 1), '/home/').url, '/about')
+        self.assertEqual(MenuPage((1, '00010001', 2, 'Home', '/home/', 1), '/home/').url, '/')
+
+    def test_menu_tree_only_shows_published_changes(self):
+        forget_menu_tree(self.wagtail_site.pk)
+        page = self.wagtail_site.root_page.add_child(instance=Page(title='About', slug='about', show_in_menus=True))
+        self.assertIn('About', self.get_menu_titles())
+
+        with run_on_commit_callbacks():
+            page.title = 'Draft title'
+            page.save_revision()
+        self.assertIn('About', self.get_menu_titles())
+
+        with run_on_commit_callbacks():
+            page.save_revision().publish()
+        self.assertIn('Draft title', self.get_menu_titles())
+        self.assertNotIn('About', self.get_menu_titles())
+
+        with run_on_commit_callbacks():
+            page.unpublish()
+        self.assertNotIn('Draft title', self.get_menu_titles())
+
+    def test_menu_trees_built_before_a_publish_never_outlive_it(self):
+        key = get_menu_tree_key(self.wagtail_site.pk)
+        version_key = get_menu_tree_version_key(self.wagtail_site.pk)
+        page = self.wagtail_site.root_page.add_child(instance=Page(title='About', slug='about', show_in_menus=True))
+        for tree_is_cached in (True, False):
+            forget_menu_tree(self.wagtail_site.pk)
+            # Another request reads the version and builds the tree before the publish commits...
+            stale_tree = build_menu_tree(self.wagtail_site, get_cache_version(version_key))
+            if not tree_is_cached:
+                cache.delete(key)
+            title = 'Published {}'.format(tree_is_cached)
+            with run_on_commit_callbacks():
+                page.title = title
+                page.save_revision().publish()
+            # ...and only gets around to storing it after the publish's update has run.
+            cache.set(key, stale_tree)
+            self.assertIn(title, self.get_menu_titles())
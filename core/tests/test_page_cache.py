@@ -0,0 +1,26 @@
+from django.test import TestCase
+from wagtail.wagtailcore.models import Page
+
+from core.page_cache import get_site_page_cache_version_key
+from core.tests.transactions import run_on_commit_callbacks
+from core.tests.utils import MultitenantSiteTestingMixin
+from core.utils import get_cache_version
+
+
+class PageCacheInvalidationTest(TestCase, MultitenantSiteTestingMixin):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.set_up_test_sites_and_users()
+
+    def get_version(self):
+        return get_cache_version(get_site_page_cache_version_key(self.wagtail_site.pk))
+
+    def test_publishing_a_page_out_of_the_menus_invalidates_the_whole_site(self):
+        page = self.wagtail_site.root_page.add_child(instance=Page(title='About', slug='about', show_in_menus=True))
+        version = self.get_version()
+
+        with run_on_commit_callbacks():
+            page.show_in_menus = False
+            page.save_revision().publish()
+        self.assertNotEqual(self.get_version(), version)
@@ -0,0 +1,38 @@
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+
+from core.permissions import get_page_permission_index, PagePermissionIndex, PERMISSION_BITS
+from core.tests.transactions import run_on_commit_callbacks
+from core.tests.utils import MultitenantSiteTestingMixin
+
+
+class PagePermissionIndexTest(SimpleTestCase):
+
+    def test_page_permission_index_unions_permissions_from_ancestors(self):
+        index = PagePermissionIndex([
+            ('00010001', PERMISSION_BITS['add']),
+            ('000100010002', PERMISSION_BITS['edit'] | PERMISSION_BITS['publish']),
+            ('00010002', PERMISSION_BITS['lock']),
+        ])
+        self.assertEqual(index.get_permissions('0001000100020005'), {'add', 'edit', 'publish'})
+        self.assertEqual(index.get_permissions('000100010003'), {'add'})
+        self.assertEqual(index.get_permissions('00010003'), set())
+        self.assertEqual(index.get_paths_with(['publish', 'lock']), ['000100010002', '00010002'])
+
+
+class PagePermissionIndexInvalidationTest(TestCase, MultitenantSiteTestingMixin):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.set_up_test_sites_and_users()
+
+    def get_permissions(self):
+        # A fresh User object, so that nothing is memoized on it.
+        user = get_user_model().objects.get(pk=self.wagtail_admin.pk)
+        return get_page_permission_index(user).get_permissions(self.wagtail_site.root_page.path)
+
+    def test_removing_a_user_from_their_groups_takes_away_their_page_permissions_once_committed(self):
+        self.assertTrue(self.get_permissions())
+        with run_on_commit_callbacks():
+            self.wagtail_admin.groups.clear()
+        self.assertEqual(self.get_permissions(), set())
@@ -0,0 +1,45 @@
+from django.http import Http404
+from django.test import TestCase, RequestFactory
+from our_sites.models.settings import Alias
+
+from core.routing import site_routing_table, unknown_host_cache, ROUTING_VERSION_KEY
+from core.tests.transactions import run_on_commit_callbacks
+from core.tests.utils import MultitenantSiteTestingMixin
+from core.utils import get_cache_version, match_site_to_request
+
+
+class SiteRoutingTableTest(TestCase, MultitenantSiteTestingMixin):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.set_up_test_sites_and_users()
+
+    def test_saving_a_root_page_bumps_the_routing_version_even_without_routes_loaded(self):
+        version = get_cache_version(ROUTING_VERSION_KEY)
+        # e.g. a Celery worker, which never routes any requests.
+        site_routing_table._routes = None
+        root_page = self.wagtail_site.root_page
+        with run_on_commit_callbacks():
+            root_page.title = 'Renamed'
+            root_page.save()
+        self.assertNotEqual(get_cache_version(ROUTING_VERSION_KEY), version)
+        self.assertEqual(site_routing_table.match(self.wagtail_site.hostname)[1].root_page.title, 'Renamed')
+
+    def test_unknown_hostnames_become_routable_once_another_process_bumps_the_version(self):
+        hostname = 'claimed-elsewhere.oursites.com'
+        request = RequestFactory().get('/', HTTP_HOST=hostname)
+        with self.assertRaises(Http404):
+            match_site_to_request(request)
+        old_routes = site_routing_table.get_routes()
+        self.assertTrue(unknown_host_cache.is_unknown(hostname, old_routes.version))
+
+        with run_on_commit_callbacks():
+            self.wagtail_site.settings.aliases.add(Alias(domain=hostname))
+            self.wagtail_site.settings.save()
+        # Put back the state of a process which never saw the alias being created, since another process created it.
+        site_routing_table._routes = old_routes
+        unknown_host_cache.add(hostname, old_routes.version)
+
+        match_type, site = match_site_to_request(request)
+        self.assertEqual(match_type, 'alias')
+        self.assertEqual(site.pk, self.wagtail_site.pk)
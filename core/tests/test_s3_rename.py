@@ -0,0 +1,32 @@
+from unittest import skipUnless
+from django.test import SimpleTestCase
+
+from core.s3_rename import rename_prefix
+try:
+    # moto provides a local stand-in for S3.
+    import boto3
+    try:
+        from moto import mock_s3
+    except ImportError:
+        # moto 5 replaced its per-service mocks with a single one.
+        from moto import mock_aws as mock_s3
+except ImportError:
+    mock_s3 = None
+
+
+@skipUnless(mock_s3, 'moto is not installed')
+class RenamePrefixTest(SimpleTestCase):
+
+    def test_s3_rename_moves_only_the_old_hostnames_files(self):
+        with mock_s3():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket='test-renames')
+            for key in ('old.example.com/images/a.jpg', 'old.example.com/documents/b.pdf', 'old.example.com.au/c.jpg'):
+                client.put_object(Bucket='test-renames', Key=key, Body=b'x')
+
+            result = rename_prefix(client, 'test-renames', 'old.example.com/', 'new.example.com/', workers=2)
+            self.assertEqual(result, {'copied': 2, 'deleted': 2, 'failures': {}})
+            keys = sorted(obj['Key'] for obj in client.list_objects_v2(Bucket='test-renames')['Contents'])
+            self.assertEqual(
+                keys, ['new.example.com/documents/b.pdf', 'new.example.com/images/a.jpg', 'old.example.com.au/c.jpg']
+            )
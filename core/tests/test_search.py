@@ -0,0 +1,55 @@
+from django.test import TestCase
+from mock import Mock, patch
+from wagtail.wagtailcore.models import Page
+
+from core.search import (
+    SITE_ID_FIELD, SiteScopedSearchBackend, SiteScopedSearchQuery, get_routing_key, get_site_routing_key,
+    reindex_page_subtree
+)
+from core.tests.utils import MultitenantSiteTestingMixin
+
+
+class SiteScopedSearchTest(TestCase, MultitenantSiteTestingMixin):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.set_up_test_sites_and_users()
+
+    def test_search_routing_key_is_the_tenant_top_level_page(self):
+        self.assertEqual(get_routing_key('0001000200030004'), '00010002')
+        self.assertEqual(get_routing_key('00010002'), '00010002')
+        self.assertIsNone(get_routing_key('0001'))
+
+    def test_page_searches_filter_on_the_current_site(self):
+        site_filter = {'term': {SITE_ID_FIELD: str(self.wagtail_site.pk)}}
+        with patch('core.search.get_current_site', return_value=self.wagtail_site):
+            self.assertIn(site_filter, SiteScopedSearchQuery(Page.objects.all(), 'hello').get_filters())
+        # Searches made outside of a request aren't scoped to any Site.
+        with patch('core.search.get_current_site', return_value=None):
+            self.assertNotIn(site_filter, SiteScopedSearchQuery(Page.objects.all(), 'hello').get_filters())
+
+    def test_page_searches_pass_the_current_site_routing_key_when_enabled(self):
+        for site_routing, routing in ((True, get_site_routing_key(self.wagtail_site)), (False, None)):
+            backend = SiteScopedSearchBackend({'SITE_ROUTING': site_routing})
+            backend.es = Mock()
+            backend.es.search.return_value = {'hits': {'hits': []}}
+            backend.es.count.return_value = {'count': 0}
+            with patch('core.search.get_current_site', return_value=self.wagtail_site):
+                results = backend.search('hello', Page)
+                list(results)
+                results.count()
+            self.assertEqual(backend.es.search.call_args[1]['routing'], routing)
+            self.assertEqual(backend.es.count.call_args[1]['routing'], routing)
+
+    def test_reindexing_a_subtree_works_through_it_in_chunks(self):
+        root_page = self.wagtail_site.root_page
+        subtree_pks = set(Page.objects.descendant_of(root_page, inclusive=True).values_list('pk', flat=True))
+        backend = Mock(site_routing=True)
+        with patch('core.search.get_search_backends', return_value=[backend]):
+            reindex_page_subtree(root_page.pk, old_routing='00010009', chunk_size=1)
+
+        delete_page_documents = backend.get_index_for_model.return_value.delete_page_documents
+        deleted_pks = [call[0][0] for call in delete_page_documents.call_args_list]
+        self.assertEqual(deleted_pks, [[pk] for pk in sorted(subtree_pks)])
+        indexed_pks = [page.pk for call in backend.add_bulk.call_args_list for page in call[0][1]]
+        self.assertEqual(indexed_pks, sorted(subtree_pks))
@@ -0,0 +1,32 @@
+from django.test import TestCase, override_settings
+from wagtail.wagtailcore.models import Page, PageViewRestriction
+
+from core.sitemap import get_site_sitemap_version_key, SiteSitemap
+from core.tests.transactions import run_on_commit_callbacks
+from core.tests.utils import MultitenantSiteTestingMixin
+from core.utils import get_cache_version
+
+
+class SitemapTest(TestCase, MultitenantSiteTestingMixin):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.set_up_test_sites_and_users()
+
+    @override_settings(WAGTAIL_APPEND_SLASH=False)
+    def test_sitemap_urls_have_no_trailing_slash(self):
+        sitemap = SiteSitemap(self.wagtail_site)
+        root_url_path = self.wagtail_site.root_page.url_path
+        self.assertEqual(
+            sitemap.render_url(root_url_path + 'about/', None),
+            '<url><loc>{}/about</loc></url>\n'.format(self.wagtail_site.root_url)
+        )
+        self.assertIn('<loc>{}/</loc>'.format(self.wagtail_site.root_url), sitemap.render_url(root_url_path, None))
+
+    def test_view_restrictions_invalidate_the_sitemap(self):
+        page = self.wagtail_site.root_page.add_child(instance=Page(title='Private', slug='private'))
+        version = get_cache_version(get_site_sitemap_version_key(self.wagtail_site.pk))
+
+        with run_on_commit_callbacks():
+            PageViewRestriction.objects.create(page=page, password='secret')
+        self.assertNotEqual(get_cache_version(get_site_sitemap_version_key(self.wagtail_site.pk)), version)
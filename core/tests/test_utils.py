@@ -0,0 +1,12 @@
+from django.test import SimpleTestCase
+
+from core.utils import get_menu_ancestor_paths, Stuff
+
+
+class MenuAncestorPathsTest(SimpleTestCase):
+
+    def test_menu_ancestor_paths_are_derived_from_the_page_path(self):
+        root_page = Stuff(path='00010001')
+        page = Stuff(path='0001000100020003')
+        self.assertEqual(get_menu_ancestor_paths(page, root_page), ['000100010002'])
+        self.assertEqual(get_menu_ancestor_paths(Stuff(path='000100020003'), root_page), ['00010002'])
@@ -0,0 +1,9 @@
+from django.test import SimpleTestCase
+
+from core.warmup import warm_templates
+
+
+class WarmupTest(SimpleTestCase):
+
+    def test_warm_templates_compiles_the_apps_templates(self):
+        self.assertGreater(warm_templates(), 0)
@@ -0,0 +1,20 @@
+from contextlib import contextmanager
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+@contextmanager
+def run_on_commit_callbacks(using=DEFAULT_DB_ALIAS):
+    """
+    Runs the callbacks that are registered with transaction.on_commit() inside this block once it exits, including any
+    which those callbacks register in turn, as if the block's changes had been committed. TestCase wraps every test in
+    a transaction that's never committed, so they'd never run otherwise. Callbacks that were registered before the
+    block (e.g. by setUpTestData()) are left alone.
+    """
+    connection = connections[using]
+    start = len(connection.run_on_commit)
+    yield
+    while len(connection.run_on_commit) > start:
+        callbacks = connection.run_on_commit[start:]
+        del connection.run_on_commit[start:]
+        for savepoint_ids, callback in callbacks:
+            callback()
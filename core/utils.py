@@ -1,23 +1,24 @@
 import ldap
+import random
 import re
-from crequest.middleware import CrequestMiddleware
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.core.cache import cache
 from django.core.validators import RegexValidator
-from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db import connection
+from django.core.exceptions import ValidationError, ObjectDoesNotExist, FieldDoesNotExist
+from django.db import connection, transaction
 from django.http import Http404
 from django.utils.deconstruct import deconstructible
 from django.utils.encoding import force_text
 from django_auth_ldap.backend import LDAPSettings, LDAPBackend, _LDAPUser
-from djunk.middleware import get_current_request
+from djunk.middleware import get_current_request, set_current_request
 from storages.backends.s3boto3 import S3Boto3Storage
 from wagtail.wagtailadmin.views.home import PagesForModerationPanel
 from wagtail.contrib.settings.registry import registry
 from wagtail.wagtailcore.models import Site, Page, Collection, UserPagePermissionsProxy
+from wagtail.wagtaildocs.models import get_document_model
 
 from core.logging import logger
 from core.modeldict import model_to_dict
@@ -87,14 +88,25 @@ class SiteHelper(object):
 
     @property
     def home_page(self):
-        return Page.objects.get(pk=self.site.root_page.id).specific
+        return self.site.root_page.specific
+
+    @property
+    def tenant(self):
+        """
+        Returns the TenantSnapshot for this Site, or None if there's no actual Site.
+        """
+        if isinstance(self.site, Stuff):
+            return None
+        # Must import locally to avoid circular import.
+        from core.tenants import get_tenant_snapshot
+        return get_tenant_snapshot(self.site)
 
     @property
     def collection(self):
         if isinstance(self.site, Stuff):
             return None
         else:
-            return Collection.objects.get(name=self.site.hostname)
+            return Collection.objects.get(pk=self.tenant.collection_id)
 
     @property
     def admins_group(self):
@@ -107,6 +119,11 @@ class SiteHelper(object):
     def group(self, short_name):
         name = self.group_name(short_name)
         if not isinstance(self.site, Stuff):
+            # The snapshot knows the pks of the Admins and Editors Groups, and pk lookups on Groups are cached by
+            # cacheops. Any other Group has to be looked up by name.
+            group_id = {'Admins': self.tenant.admins_group_id, 'Editors': self.tenant.editors_group_id}.get(short_name)
+            if group_id is not None:
+                return Group.objects.get(pk=group_id)
             return Group.objects.get(name=name)
         else:
             return Stuff(name=name, pk=name)
@@ -158,6 +175,20 @@ def get_installed_site_settings_class():
     return None
 
 
+def get_alias_model():
+    """
+    Returns the model class that stores the aliases of the installed SiteSettings class, or None if there isn't one.
+    core can't import that model directly, because it belongs to whichever app defines the site type.
+    """
+    settings_class = get_installed_site_settings_class()
+    if settings_class is None:
+        return None
+    try:
+        return settings_class._meta.get_field('aliases').related_model
+    except FieldDoesNotExist:
+        return None
+
+
 @deconstructible
 class HostnameValidator(object):
     """
@@ -228,22 +259,26 @@ def match_site_to_request(request):
 
     This function returns a tuple of (<match-type>, Site), where <match-type> can be 'hostname' or 'alias'.
     It also pre-selects the Site's settings, root_page, and features attributes, for performance reasons.
+
+    The lookups are answered from the per-process routing table in core.routing, so this function usually makes no
+    database queries at all.
     """
-    query = Site.objects.select_related('settings', 'root_page', 'features')
+    # Must import locally to avoid circular import.
+    from core.routing import site_routing_table, unknown_host_cache
     try:
         hostname = request.META['HTTP_HOST'].split(':')[0]
+        # Fetch the routes first, since that checks their version. An unknown hostname may have been claimed by a Site
+        # or alias that another process created since we last failed to match it.
+        routes = site_routing_table.get_routes()
+        if unknown_host_cache.is_unknown(hostname, routes.version):
+            # We've recently failed to match this hostname, so don't bother looking it up again.
+            raise Http404()
         try:
-            # Find a Site matching this specific hostname.
-            return ['hostname', query.get(hostname=hostname)]
-        except Site.MultipleObjectsReturned:
-            # As there were more than one, try matching by port, too.
-            port = int(request.META['SERVER_PORT'])
-            # Site.DoesNotExist thrown from this get() call goes to the final except clause.
-            return ['hostname', query.get(hostname=hostname, port=port)]
+            # The port is only consulted when more than one Site shares this hostname.
+            return site_routing_table.match(hostname, request.META.get('SERVER_PORT'), routes)
         except Site.DoesNotExist:
-            # This except clause catches "no Site exists with this hostname", in which case we check if the
-            # hostname matches an alias. Site.DoesNotExist thrown from this get() call goes to the final except clause.
-            return ['alias', query.get(settings__aliases__domain=hostname)]
+            unknown_host_cache.add(hostname, routes.version)
+            raise
     except KeyError:
         # If the HTTP_HOST header is missing, this is probably a test, because any on-spec HTTP client must include it.
         # The spec says to throw a 400 if that rule is violated.
@@ -263,11 +298,12 @@ def get_domains_for_current_site():
     alias_domains = []
     if site:
         alias_domains.append(site.hostname)
-        try:
-            alias_domains = [alias.domain for alias in site.settings.aliases.all()]
-        except:
-            # This is a generic "except" because core can't know which settings class's DoesNotExist might get thrown.
-            pass
+        # Must import locally to avoid circular import.
+        from core.tenants import get_tenant_snapshot
+        tenant = get_tenant_snapshot(site)
+        # A Site without settings has no aliases, so it keeps just the hostname.
+        if tenant.settings_pk is not None:
+            alias_domains = list(tenant.alias_domains)
     return alias_domains
 
 
@@ -281,7 +317,7 @@ def domain_erase(domains, text):
     return re.sub(regex, '', text)
 
 
-def get_page_tree(request, max_depth=3):
+def get_page_tree(request, max_depth=3, specific=False):
     """
     Returns the menu tree as a "depth list", a list of lists of each level of the tree.
     Pass the return value of this function into the core/menus/desktop.tpl template, and it will render a <ul> tree.
@@ -289,19 +325,21 @@ def get_page_tree(request, max_depth=3):
     By default, this function returns the first three levels of the menu tree for the current site. But you can pass
     in max_depth to change the level upon which the menu terminates.
 
-    If retrieveing the menu tree for the purposes of building the sitemap, this function will return ALL the pages
-    below and icluding the current Site's rootpage, instead of just the live, on-menu pages that descend from it.
+    The pages in the tree are MenuPages (see core.menus), read from the current Site's cached menu tree, so building
+    the tree doesn't need any database queries. Their title, url, url_path, and depth are all a menu template usually
+    needs. A MenuPage's specific attribute gets the real Page, but if the template reads per-type fields from every
+    page in the tree, pass specific=True to fetch them all up front, with one query per Page type.
     """
-    # Build the default query that will be used by both menu and sitemap.
-    pages = Page.objects.order_by('path').specific()
-
-    # The menu needs only live, on-menu pages below the homepage (so we can't use in_site()), up to a specified depth.
-    pages = pages.descendant_of(request.site.root_page, inclusive=False).filter(show_in_menus=True, live=True)
-    # The Root page and the Site's homepage live at depths 1 and 2, which is why we add 2 to max_depth.
-    pages = pages.filter(depth__lte=max_depth+2)
+    # Must import locally to avoid circular import.
+    from core.menus import get_menu_pages, prefetch_specific
 
-    # Add the ultimate root page to the queryset. We need it for the depth_list algorithm.
-    pages = pages | Page.objects.filter(depth=1)
+    # The menu needs only live, on-menu pages below the homepage, up to a specified depth.
+    menu_pages = get_menu_pages(request.site, max_depth)
+    if specific:
+        prefetch_specific(menu_pages)
+    # We also need the ultimate root page for the depth_list algorithm, but only its path, so a placeholder with the
+    # shortest possible path will do.
+    pages = [Stuff(path='', depth=1)] + menu_pages
 
     # Turn 'pages' into a tree structure:
     #     tree_node = (page, children)
@@ -379,11 +417,63 @@ def search_ldap_for_user(username):
     return None
 
 
-def user_is_member_of_site(user, site):
+# Site membership verdicts are stored in the session under this key, as {'<user_pk>:<site_pk>': [verdict, versions]}.
+SITE_MEMBERSHIP_SESSION_KEY = 'site_membership'
+# Bumped whenever Groups might have been renamed, which can change any User's membership in any Site.
+SITE_MEMBERSHIP_VERSION_KEY = 'site-membership-version'
+
+
+def get_user_site_membership_version_key(user_pk):
+    """
+    Returns the cache key of the version that's bumped whenever the given User's Groups change.
+    """
+    return '{}-{}'.format(SITE_MEMBERSHIP_VERSION_KEY, user_pk)
+
+
+def get_site_membership_versions(user_pk):
+    """
+    Returns the [global, per-user] pair of versions that a memoized site membership verdict for the given User must
+    have been computed under to still be valid.
+    """
+    keys = [SITE_MEMBERSHIP_VERSION_KEY, get_user_site_membership_version_key(user_pk)]
+    versions = cache.get_many(keys)
+    return [versions[key] if key in versions else get_cache_version(key) for key in keys]
+
+
+def user_is_member_of_site(user, site, request=None):
     """
     Returns True if the given User is the member of a Group associated with the given Site.
+
+    When the User is the one making the request (which defaults to the current request), the verdict is memoized on the
+    request, and in the session for as long as the User's Groups stay the same. See core.signals for the invalidation.
     """
-    return user.groups.filter(name__startswith=site.hostname).exists()
+    if request is None:
+        request = get_current_request()
+    if request is None or getattr(getattr(request, 'user', None), 'pk', None) != user.pk:
+        return user.groups.filter(name__startswith=site.hostname).exists()
+
+    memo_key = '{}:{}'.format(user.pk, site.pk)
+    if not hasattr(request, '_site_membership'):
+        request._site_membership = {}
+    if memo_key in request._site_membership:
+        return request._site_membership[memo_key]
+
+    versions = get_site_membership_versions(user.pk)
+    session = getattr(request, 'session', None)
+    verdicts = session.get(SITE_MEMBERSHIP_SESSION_KEY, {}) if session is not None else {}
+    try:
+        is_member, verdict_versions = verdicts[memo_key]
+    except KeyError:
+        verdict_versions = None
+
+    if verdict_versions != versions:
+        is_member = user.groups.filter(name__startswith=site.hostname).exists()
+        if session is not None:
+            verdicts[memo_key] = [is_member, versions]
+            session[SITE_MEMBERSHIP_SESSION_KEY] = verdicts
+
+    request._site_membership[memo_key] = is_member
+    return is_member
 
 
 def populate_user_from_ldap(user):
@@ -413,17 +503,51 @@ def populate_user_from_ldap(user):
         )
 
 
+def get_menu_ancestor_paths(page, root_page):
+    """
+    Returns the treebeard paths of the given Page's ancestors which lie below the given root page, derived from the
+    Page's own path. If the Page isn't below the root page, every ancestor except the ultimate root page is returned.
+    """
+    steplen = Page.steplen
+    if page.path.startswith(root_page.path):
+        start = len(root_page.path) + steplen
+    else:
+        start = 2 * steplen
+    return [page.path[:end] for end in range(start, len(page.path), steplen)]
+
+
 def page_is_off_menu(page, request):
     """
     Determines if this page should be considered "off the menu" due to having an ancestor that's off it.
     """
-    # "page.pk > 1" is a sanity check to make sure we don't infinite loop or crash under any circumstance.
     # The "page.pk is not None" check is for when the user is previewing an unsaved Page.
-    while page.pk is not None and page.pk != request.site.root_page.pk and page.pk > 1:
-        if not page.show_in_menus:
-            return True
-        page = page.get_parent()
-    return False
+    if page.pk is None or page.pk == request.site.root_page.pk or page.depth <= 1:
+        return False
+    # The page itself is checked as it is in memory, since it may be a preview of unsaved changes.
+    if not page.show_in_menus:
+        return True
+    ancestor_paths = get_menu_ancestor_paths(page, request.site.root_page)
+    return bool(ancestor_paths) and Page.objects.filter(path__in=ancestor_paths, show_in_menus=False).exists()
+
+
+def get_off_menu_page_pks(pages, request):
+    """
+    The batch version of page_is_off_menu(), for e.g. listing pages and search results. Returns the set of pks of the
+    given pages that are off the menu, using a single query.
+    """
+    root_page = request.site.root_page
+    pages = [page for page in pages if page.pk is not None and page.pk != root_page.pk and page.depth > 1]
+    pages_and_paths = [(page, get_menu_ancestor_paths(page, root_page)) for page in pages]
+    all_paths = set(path for page, paths in pages_and_paths for path in paths)
+    off_menu_paths = set()
+    if all_paths:
+        off_menu_paths = set(
+            Page.objects.filter(path__in=all_paths, show_in_menus=False).values_list('path', flat=True)
+        )
+    return {
+        page.pk for page, paths in pages_and_paths
+        if not page.show_in_menus or any(path in off_menu_paths for path in paths)
+    }
 
 
 def store_key_value_pair(key, value, expire_duration=None):
@@ -445,13 +569,61 @@ def get_key_value_pair(key, default=None):
     return cache.get(key, default)
 
 
+def new_cache_version():
+    """
+    Returns a random starting value for a version counter. A counter which is missing from the cache (because it was
+    never bumped, or because redis evicted it) starts again from one of these, rather than from a fixed value that
+    something might already have been built or memoized under.
+    """
+    return random.getrandbits(48)
+
+
+def get_cache_version(key):
+    """
+    Returns the current value of the version counter stored at the given key, starting a new counter if there isn't
+    one. Per-process caches compare this value against the version they were built from to learn that another process
+    has invalidated them.
+    """
+    version = cache.get(key)
+    if version is None:
+        # add() is a no-op if another process started the counter first, so read it back to agree with that process.
+        cache.add(key, new_cache_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(key):
+    """
+    Atomically increments the version counter stored at the given key, and returns the new version. Version counters
+    never expire, since an expired counter would look to every process like a version it has already seen.
+    """
+    # add() is a no-op if the key already exists, so this only initializes brand new counters.
+    cache.add(key, new_cache_version(), None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The dummy cache (used when DISABLE_CACHE is set) can't store counters, so there's nothing to bump.
+        return None
+
+
+def bump_cache_versions_on_commit(*keys):
+    """
+    Bumps the version counters stored at the given keys once the current transaction commits. Bumping them any earlier
+    could let a concurrent request recompute whatever they guard from the old data, and store it under the new versions.
+    """
+    def bump():
+        for key in keys:
+            bump_cache_version(key)
+    transaction.on_commit(bump)
+
+
 def set_fake_current_request(site, user):
     """
     Set's the "current request" to a FakeRequest object with the given Site and User.
     """
     # Create the "FakeRequest" class in-place and instantiate it.
     request = type('FakeRequest', (object,), {'site': site, 'user': user})()
-    CrequestMiddleware.set_request(request)
+    set_current_request(request)
 
 
 # noinspection PyAbstractClass
@@ -526,6 +698,12 @@ def update_db_for_hostname_change(old_hostname, new_hostname):
     core_ourrendition - Same as above.
     core_sitespecifictag - These do have an FK to the Site, but their slugs also have to be prefixed for uniqueness.
     """
+    # Must import locally to avoid circular import.
+    from core.documents import forget_document_metadata
+    # The cached metadata of these Documents holds their old file paths.
+    renamed_document_ids = list(
+        get_document_model().objects.filter(file__contains=old_hostname).values_list('pk', flat=True)
+    )
     commands = [
         "UPDATE auth_group SET `name` = REPLACE(`name`, %s, %s)",
         "UPDATE wagtailcore_collection SET `name` = REPLACE(`name`, %s, %s)",
@@ -537,3 +715,12 @@ def update_db_for_hostname_change(old_hostname, new_hostname):
     with connection.cursor() as cursor:
         for command in commands:
             cursor.execute(command, [old_hostname, new_hostname])
+
+    # The Groups and Collections were renamed behind the ORM's back, so no signals were sent. Invalidate every memoized
+    # site membership verdict and tenant snapshot by hand.
+    bump_cache_versions_on_commit(SITE_MEMBERSHIP_VERSION_KEY)
+    if renamed_document_ids:
+        transaction.on_commit(lambda: forget_document_metadata(*renamed_document_ids))
+    # Must import locally to avoid circular import.
+    from core.tenants import tenant_snapshots
+    tenant_snapshots.invalidate()
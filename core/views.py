@@ -0,0 +1,25 @@
+from django.http import Http404, StreamingHttpResponse
+from django.urls import reverse
+
+from core.sitemap import SiteSitemap
+
+
+def sitemap(request):
+    """
+    Serves the current Site's sitemap. Sites with too many pages for a single sitemap get a sitemap index instead,
+    which points to each of the sections served by sitemap_section().
+    """
+    site_sitemap = SiteSitemap(request.site)
+    if len(site_sitemap.get_section_starts()) > 1:
+        content = site_sitemap.stream_index(lambda section: reverse('sitemap_section', args=[section]))
+    else:
+        content = site_sitemap.stream_section(0)
+    return StreamingHttpResponse(content, content_type='application/xml')
+
+
+def sitemap_section(request, section):
+    site_sitemap = SiteSitemap(request.site)
+    section = int(section)
+    if section >= len(site_sitemap.get_section_starts()):
+        raise Http404
+    return StreamingHttpResponse(site_sitemap.stream_section(section), content_type='application/xml')
@@ -0,0 +1,73 @@
+"""
+Fills this process's caches before it serves any requests. project/gunicorn_config.py calls warm_up() in the gunicorn
+master when GUNICORN_PRELOAD is enabled, so that every worker inherits the warm caches copy-on-write when it's forked,
+rather than paying for them on its first few requests.
+"""
+import os
+import time
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.template import engines, TemplateSyntaxError, TemplateDoesNotExist
+
+from core.logging import logger
+from core.routing import site_routing_table
+from core.tenants import tenant_snapshots
+
+
+def warm_site_caches():
+    """
+    Builds the site routing table and every Site's TenantSnapshot. Returns the number of Sites.
+    """
+    routes = site_routing_table.get_routes()
+    for site in routes.sites.values():
+        tenant_snapshots.get(site)
+    return len(routes.sites)
+
+
+def warm_content_types():
+    """
+    Fills ContentTypeManager's per-process cache, which permission checks and generic relations consult constantly.
+    """
+    ContentType.objects.get_for_models(*apps.get_models())
+
+
+def get_template_names(template_dir):
+    for dirpath, dirnames, filenames in os.walk(template_dir):
+        for filename in filenames:
+            if filename.endswith(('.html', '.tpl', '.txt', '.xml')):
+                yield os.path.relpath(os.path.join(dirpath, filename), template_dir)
+
+
+def warm_templates():
+    """
+    Compiles every template in every Django template engine's directories, which stores them in the cached template
+    loader. Returns the number of templates compiled. Templates which don't compile on their own (e.g. fragments
+    which depend on a tag library loaded by the template that includes them) are skipped.
+    """
+    count = 0
+    for engine in engines.all():
+        # The backend's template_dirs include each app's templates directory, when APP_DIRS is enabled.
+        for template_dir in engine.template_dirs:
+            for name in get_template_names(template_dir):
+                try:
+                    engine.get_template(name)
+                except (TemplateSyntaxError, TemplateDoesNotExist, UnicodeDecodeError):
+                    continue
+                count += 1
+    return count
+
+
+def warm_up():
+    """
+    Warms all of the above, then closes this process's database connections, since a connection opened before a fork
+    must never be shared by the forked processes.
+    """
+    start = time.time()
+    try:
+        sites = warm_site_caches()
+        warm_content_types()
+        templates = warm_templates()
+    finally:
+        connections.close_all()
+    logger.info('warmup.complete', sites=sites, templates=templates, seconds=round(time.time() - start, 2))
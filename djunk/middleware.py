@@ -1,8 +1,11 @@
 import re
+from functools import lru_cache
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http.response import HttpResponsePermanentRedirect
 from django.utils.http import urlencode
-from crequest.middleware import CrequestMiddleware
+from djunk import request_context
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
@@ -15,16 +18,31 @@ def get_current_request(default=None):
     current request, e.g. when get_current_request() is called during a manage.py command.
 
     2017-07-24: This function now uses django-crequest instead of GlobalRequestMiddleware, and accepts a default arg.
+    2026-10-16: This function now uses djunk.request_context instead of django-crequest, so it works under threaded,
+    greenlet, and asyncio workers.
     """
-    return CrequestMiddleware.get_request(default)
+    request = request_context.get_request()
+    return request if request is not None else default
+
+
+def set_current_request(request):
+    """
+    Makes the given request the current one. Returns a token which can be passed to
+    djunk.request_context.reset_request() to restore the previous one.
+    """
+    return request_context.set_request(request)
 
 
 def get_current_user(default=None):
     """
-    Returns the user responsible for the current request.
+    Returns the user responsible for the current request, unless a different user has been set with
+    djunk.request_context.set_user().
 
     2017-07-24: This function now uses django-crequest instead of GlobalRequestMiddleware, and accepts a default arg.
     """
+    user = request_context.get_user()
+    if user is not None:
+        return user
     try:
         return get_current_request().user
     except AttributeError:
@@ -32,6 +50,26 @@ def get_current_user(default=None):
         return default
 
 
+class CurrentRequestMiddleware(object):
+    """
+    Enables the use of get_current_request() and get_current_user() for the duration of each request.
+
+    This replaces django-crequest's CrequestMiddleware. The request is stored in a context variable, and the previous
+    value is restored on the way out, so nested middleware chains (e.g. Wagtail's page previews) and concurrent requests
+    in the same process can't clobber each other's current request.
+    """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request_context.set_request(request)
+        try:
+            return self.get_response(request)
+        finally:
+            request_context.reset_request(token)
+
+
 class BindViewDataToRequestMiddleware(MiddlewareMixin):
     """
     Binds data about the view being served by this request into the request object.
@@ -46,18 +84,95 @@ class BindViewDataToRequestMiddleware(MiddlewareMixin):
             'callback': view,
             'args': view_args,
             'kwargs': view_kwargs,
-            'view_name': view.func_name,
+            # Class-based views' as_view() functions are named after the class, but other callables may not be named.
+            'view_name': getattr(view, '__name__', view.__class__.__name__),
             # Since we name our namepsaces the same as our apps, we can use it as the app name if app_name isn't set.
             'app_name': request.resolver_match.app_name or request.resolver_match.namespace,
         }
 
 
+class SlashedPathMatcher(object):
+    """
+    Decides which paths SlashMiddleware should redirect, and where to. The SLASHED_PATHS setting is compiled into a
+    single anchored regex (which only matches a prefix at a path segment boundary, so '/admin' matches '/admin' and
+    '/admin/pages', but not '/administrator'), and the SITE_SLASHED_PATHS setting (a dict mapping hostnames to lists of
+    additional prefixes) into one regex per hostname. Redirect targets are cached per (hostname, path), since the same
+    few paths are requested over and over.
+    """
+
+    def __init__(self, slashed_paths, site_slashed_paths=None, cache_size=4096):
+        self.default_regex = self.compile(slashed_paths)
+        self.site_regexes = {
+            hostname.lower(): self.compile(list(slashed_paths) + list(paths))
+            for hostname, paths in (site_slashed_paths or {}).items()
+        }
+        self._get_redirect_path = lru_cache(maxsize=cache_size)(self._compute_redirect_path)
+
+    @staticmethod
+    def compile(prefixes):
+        """
+        Returns a regex which matches any path that is one of the given prefixes, or starts with one of them followed by
+        a slash. Returns None if there are no prefixes.
+        """
+        if not prefixes:
+            return None
+        return re.compile('(?:{})(?:/|$)'.format('|'.join(re.escape(prefix) for prefix in prefixes)))
+
+    def _compute_redirect_path(self, hostname, path):
+        regex = self.site_regexes.get(hostname, self.default_regex)
+        slashed = regex is not None and regex.match(path) is not None
+        if slashed and not path.endswith('/'):
+            # Redirect to slashed versions.
+            return path + '/'
+        elif not slashed and path.endswith('/') and not path == '/':
+            # Redirect to unslashed versions.
+            return path[:-1]
+        return None
+
+    def get_redirect_path(self, hostname, path):
+        """
+        Returns the path that the given path on the given hostname should be redirected to, or None if it shouldn't be.
+        """
+        # Hostnames without rules of their own all share the same cache entries, so that requests for random hostnames
+        # can't flood the cache.
+        hostname = hostname.lower()
+        return self._get_redirect_path(hostname if hostname in self.site_regexes else None, path)
+
+
+_slashed_path_matcher = None
+
+
+def get_slashed_path_matcher():
+    """
+    Returns the SlashedPathMatcher for the current settings, building it if necessary.
+    """
+    global _slashed_path_matcher
+    matcher = _slashed_path_matcher
+    if matcher is None:
+        matcher = _slashed_path_matcher = SlashedPathMatcher(
+            getattr(settings, 'SLASHED_PATHS', []), getattr(settings, 'SITE_SLASHED_PATHS', {})
+        )
+    return matcher
+
+
+# noinspection PyUnusedLocal
+@receiver(setting_changed)
+def reset_slashed_path_matcher(sender, setting, **kwargs):
+    """
+    Throws away the SlashedPathMatcher when either of the settings it was built from changes (e.g. in tests).
+    """
+    global _slashed_path_matcher
+    if setting in ('SLASHED_PATHS', 'SITE_SLASHED_PATHS'):
+        _slashed_path_matcher = None
+
+
 class SlashMiddleware(MiddlewareMixin):
     """
     SlashMiddleware reads from the SLASHED_PATHS setting to determine which URLs to redirect from e.g. /page/ to /page
     (for aesthetics), and which to redirect from e.g. /admin to /admin/ (for hardcoded URLs that require end-slashes).
 
     SLASHED_PATHS must be a list of strings that start with a slash but DON'T end with one, e.g. '/admin'.
+    SITE_SLASHED_PATHS may optionally map hostnames to lists of additional such strings, for Sites that need them.
 
     This middleware must go first in the MIDDLEWARE_CLASSES setting. You should remove
     django.middleware.common.CommonMiddleware, as its functionality conflicts with SlashMiddleware.
@@ -68,24 +183,19 @@ class SlashMiddleware(MiddlewareMixin):
     They will conflict with SlashMiddleware if they are left with their default values.
     """
 
+    def __init__(self, get_response=None):
+        super(SlashMiddleware, self).__init__(get_response)
+        # Compile the matcher now, rather than during the first request.
+        get_slashed_path_matcher()
+
     def process_request(self, request):
         """
         Redirects all unslashed paths that match the SLASHED_PATHS setting to their slashed version.
         Redirects all slashed paths that don't match the SLASHED_PATHS setting to their slashless version.
         """
-        # For some dumb reason, str.startswith() ONLY accepts tuples of strings.
-        # Thus, we cast to tuple to allow our users to use any sequence type for SLASHED_PATHS.
-        slashed_paths = tuple(getattr(settings, 'SLASHED_PATHS', []))
-
-        if request.path.startswith(slashed_paths) and not request.path.endswith('/'):
-            # Redirect to slashed versions.
-            url = request.path + '/'
-            if request.GET:
-                url += '?{}'.format(urlencode(request.GET, True))
-            return HttpResponsePermanentRedirect(url)
-        elif (not request.path.startswith(slashed_paths) and request.path.endswith('/') and not request.path == '/'):
-            # Redirect to unslashed versions.
-            url = request.path[:-1]
+        hostname = request.META.get('HTTP_HOST', '').split(':')[0]
+        url = get_slashed_path_matcher().get_redirect_path(hostname, request.path)
+        if url is not None:
             if request.GET:
                 url += '?{}'.format(urlencode(request.GET, True))
             return HttpResponsePermanentRedirect(url)
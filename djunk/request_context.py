@@ -0,0 +1,57 @@
+"""
+Per-request state that has to be reachable from code which isn't handed the request, e.g. logging processors and
+model methods. The state is kept in context variables rather than thread-locals, so it stays correct whether requests
+are served by threads, greenlets, or asyncio tasks.
+"""
+from contextvars import ContextVar
+
+_current_request = ContextVar('djunk_current_request', default=None)
+_current_user = ContextVar('djunk_current_user', default=None)
+_middleware_iterations = ContextVar('djunk_middleware_iterations', default=0)
+
+
+def get_request():
+    return _current_request.get()
+
+
+def set_request(request):
+    """
+    Makes the given request the current one, and returns a token which can be passed to reset_request() to undo that.
+    """
+    return _current_request.set(request)
+
+
+def reset_request(token):
+    _current_request.reset(token)
+
+
+def get_user():
+    return _current_user.get()
+
+
+def set_user(user):
+    """
+    Overrides the current user, e.g. for work done outside a request on some user's behalf. Returns a token which can
+    be passed to reset_user() to undo the override.
+    """
+    return _current_user.set(user)
+
+
+def reset_user(token):
+    _current_user.reset(token)
+
+
+def get_middleware_iterations():
+    return _middleware_iterations.get()
+
+
+def increment_middleware_iterations():
+    """
+    Records that the middleware chain has been entered once more in the current context, and returns a token which
+    must be passed to reset_middleware_iterations() when the chain is exited.
+    """
+    return _middleware_iterations.set(_middleware_iterations.get() + 1)
+
+
+def reset_middleware_iterations(token):
+    _middleware_iterations.reset(token)
@@ -0,0 +1,54 @@
+from django.test import SimpleTestCase, RequestFactory, override_settings
+
+from djunk.middleware import SlashedPathMatcher, SlashMiddleware, get_slashed_path_matcher
+
+
+class SlashedPathMatcherTest(SimpleTestCase):
+
+    def setUp(self):
+        self.matcher = SlashedPathMatcher(['/admin', '/django-admin'], {'Law.oursites.com': ['/journal']})
+
+    def test_slashed_prefixes_get_a_trailing_slash_and_other_paths_lose_theirs(self):
+        self.assertEqual(self.matcher.get_redirect_path('www.oursites.com', '/admin'), '/admin/')
+        self.assertEqual(self.matcher.get_redirect_path('www.oursites.com', '/admin/pages'), '/admin/pages/')
+        self.assertIsNone(self.matcher.get_redirect_path('www.oursites.com', '/admin/'))
+        self.assertIsNone(self.matcher.get_redirect_path('www.oursites.com', '/admin/pages/'))
+        self.assertEqual(self.matcher.get_redirect_path('www.oursites.com', '/about/'), '/about')
+        self.assertIsNone(self.matcher.get_redirect_path('www.oursites.com', '/about'))
+        self.assertIsNone(self.matcher.get_redirect_path('www.oursites.com', '/'))
+
+    def test_slashed_prefixes_do_not_match_longer_sibling_paths(self):
+        self.assertIsNone(self.matcher.get_redirect_path('www.oursites.com', '/administrator'))
+        self.assertEqual(self.matcher.get_redirect_path('www.oursites.com', '/administrator/'), '/administrator')
+        self.assertIsNone(self.matcher.get_redirect_path('www.oursites.com', '/django-admins'))
+
+    def test_site_slashed_paths_only_apply_to_their_hostname(self):
+        self.assertEqual(self.matcher.get_redirect_path('LAW.oursites.com', '/journal'), '/journal/')
+        self.assertEqual(self.matcher.get_redirect_path('law.oursites.com', '/admin'), '/admin/')
+        self.assertIsNone(self.matcher.get_redirect_path('www.oursites.com', '/journal'))
+        self.assertEqual(self.matcher.get_redirect_path('www.oursites.com', '/journal/'), '/journal')
+
+
+class SlashMiddlewareTest(SimpleTestCase):
+
+    def get_redirect_url(self, path, hostname='law.oursites.com'):
+        response = SlashMiddleware().process_request(RequestFactory().get(path, HTTP_HOST=hostname))
+        return response.url if response is not None else None
+
+    @override_settings(SLASHED_PATHS=['/admin'], SITE_SLASHED_PATHS={})
+    def test_redirects_keep_the_query_string(self):
+        self.assertEqual(self.get_redirect_url('/admin?next=/about'), '/admin/?next=%2Fabout')
+        self.assertEqual(self.get_redirect_url('/about/?page=2'), '/about?page=2')
+
+    @override_settings(SLASHED_PATHS=['/admin'], SITE_SLASHED_PATHS={})
+    def test_changing_the_settings_rebuilds_the_matcher(self):
+        matcher = get_slashed_path_matcher()
+        self.assertEqual(self.get_redirect_url('/journal/'), '/journal')
+        with override_settings(SITE_SLASHED_PATHS={'law.oursites.com': ['/journal']}):
+            self.assertIsNot(get_slashed_path_matcher(), matcher)
+            self.assertIsNone(self.get_redirect_url('/journal/'))
+            self.assertEqual(self.get_redirect_url('/journal'), '/journal/')
+        with override_settings(SLASHED_PATHS=['/journal']):
+            self.assertEqual(self.get_redirect_url('/journal', hostname='www.oursites.com'), '/journal/')
+            self.assertEqual(self.get_redirect_url('/admin/', hostname='www.oursites.com'), '/admin')
+        self.assertEqual(self.get_redirect_url('/journal/'), '/journal')
@@ -25,8 +25,9 @@ app.autodiscover_tasks()
 
 def with_lock(f):
     """
-    Acquire a distributed lock in redis before running the Celery task.  If we
-    can't acquire the lock, log that we couldn't and end the task.
+    Acquire a distributed lock in redis before running the Celery task, and
+    return what it returns.  If we can't acquire the lock, log that we couldn't
+    and end the task.
 
     For logging purposes, we're assuming that every task is a Django manage.py
     command, that ``f`` is always ``django.core.management.call_command`` and
@@ -48,7 +49,7 @@ def with_lock(f):
         try:
             have_lock = lock.acquire(blocking=False)
             if have_lock:
-                f(*args, **kwargs)
+                return f(*args, **kwargs)
             else:
                 logger.info('celery.task.lock.already_locked', task=f.__name__)
         finally:
@@ -14,6 +14,33 @@ threads = 1
 # noinspection PyShadowingBuiltins
 reload = getenv('GUNICORN_RELOAD', False)
 
+# In preload mode, the app is loaded in the gunicorn master, whose caches are then warmed (see core.warmup) before the
+# workers are forked, so that every worker starts with them warm. Preloading can't be combined with reloading, since the
+# master would never see the new code.
+preload_app = getenv('GUNICORN_PRELOAD', False) and not reload
+
+
+# noinspection PyUnusedLocal
+def when_ready(server):
+    """
+    Runs in the master once it's ready to fork the workers.
+    """
+    if preload_app:
+        from core.warmup import warm_up
+        warm_up()
+
+
+# noinspection PyUnusedLocal
+def post_worker_init(worker):
+    """
+    Runs in each worker once it has loaded the app. Without preloading, each worker has to warm its own caches, except
+    during development, where it would only slow down reloads.
+    """
+    if not preload_app and not reload:
+        from core.warmup import warm_up
+        warm_up()
+
+
 # If remote debugging is enabled set the timeout very high, so one can pause for a long time in the debugger.
 # Also set the number of workers to 1, which improves the debugging experience by not overwhleming the remote debugger.
 if getenv('REMOTE_DEBUG_ENABLED', False):
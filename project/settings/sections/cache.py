@@ -27,6 +27,15 @@ CACHEOPS = {
     '*.*': {'timeout': 60*60},
 }
 
+# Config for core.page_cache, which caches the pages that anonymous visitors see, per tenant.
+PAGE_CACHE_ENABLED = getenv('PAGE_CACHE_ENABLED', True)
+PAGE_CACHE_TIMEOUT = getenv('PAGE_CACHE_TIMEOUT', 60*5)
+# Query string parameters which don't affect the rendered page, and so are left out of the cache key.
+PAGE_CACHE_IGNORED_QUERY_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'fbclid')
+# URLs of edge caches (e.g. Varnish or Fastly purge endpoints) that should be sent a PURGE request, with a
+# Surrogate-Key header, whenever a tenant's pages change.
+PAGE_CACHE_PURGE_URLS = [url for url in getenv('PAGE_CACHE_PURGE_URLS', '').split(',') if url]
+
 # Disable all caching if the optional DISABLE_CACHE env var is True.
 if getenv('DISABLE_CACHE', False):
     CACHES = {
@@ -35,3 +44,4 @@ if getenv('DISABLE_CACHE', False):
         }
     }
     CACHEOPS_ENABLED = False
+    PAGE_CACHE_ENABLED = False
@@ -54,3 +54,6 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = 'redis://{}:6379/0'.format(getenv('CACHE'))
 CELERY_BROKER_URL = 'redis://{}:6379/0'.format(getenv('CACHE'))
+# The redis broker redelivers any acks_late task which hasn't been acknowledged within this many seconds, whether or not
+# its worker is still running it. It must be longer than the longest such task (see core.tasks.RENAME_LOCK_TIMEOUT).
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 60 * 60 * 12}
@@ -54,6 +54,9 @@ if getenv('TESTING', False):
     # elasticsearch sometimes).
     LOGGING['root']['level'] = 'WARN'
 
+    # Tests inspect freshly rendered responses, so never serve them from the page cache.
+    PAGE_CACHE_ENABLED = False
+
     # Don't polute the dev search index with test search content.
     WAGTAILSEARCH_BACKENDS['default']['INDEX'] = 'test'
 
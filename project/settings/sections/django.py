@@ -71,6 +71,8 @@ MIDDLEWARE = [
     # This one has to go first because it replaces django.middleware.common.CommonMiddleware, which has to be first.
     'djunk.middleware.SlashMiddleware',
     'core.middleware.MiddlewareIterationCounter',
+    # Records which view served each request, for core.cache_tags.
+    'djunk.middleware.BindViewDataToRequestMiddleware',
 
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -81,6 +83,7 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
 
     'core.middleware.MultitenantSiteMiddleware',
+    'core.middleware.AnonymousPageCacheMiddleware',
     'wagtail.wagtailredirects.middleware.RedirectMiddleware',
 
     # Enables the use of the get_current_request() and get_current_user() functions.
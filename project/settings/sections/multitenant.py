@@ -9,3 +9,11 @@ SERVER_DOMAIN = getenv('SERVER_DOMAIN')
 # Specify the prefixes for paths that NEED to end in slash, so that SlashMiddleware can redirect us to them from their
 # slashless versions. e.g. going to /admin/login will redirect to /admin/login/
 SLASHED_PATHS = ['/admin', '/django-admin']
+# Maps hostnames to lists of additional slashed paths, for Sites that need their own, e.g.
+# {'law.oursites.com': ['/journal']}
+SITE_SLASHED_PATHS = {}
+
+# Hostnames that match no Site are remembered for this many seconds, so that repeated requests for them (e.g. from
+# scanners or spoofed Host headers) go straight to a 404. At most UNKNOWN_HOST_CACHE_SIZE of them are kept per process.
+UNKNOWN_HOST_CACHE_TTL = getenv('UNKNOWN_HOST_CACHE_TTL', 60)
+UNKNOWN_HOST_CACHE_SIZE = getenv('UNKNOWN_HOST_CACHE_SIZE', 1000)
@@ -13,11 +13,13 @@ APPEND_SLASH = False
 # Elasticsearch
 WAGTAILSEARCH_BACKENDS = {
     'default': {
-        'BACKEND': 'wagtail.wagtailsearch.backends.elasticsearch5',
+        'BACKEND': 'core.search',
         'URLS': getenv('WAGTAIL_ELASTICSEARCH_URL').split(','),
         'INDEX': 'wagtail-multi',
         'TIMEOUT': 120,
         'ATOMIC_REBUILD': True,
+        # Route each tenant's Page documents to a single shard. Run update_index after changing this.
+        'SITE_ROUTING': getenv('WAGTAILSEARCH_SITE_ROUTING', False),
     }
 }
 
@@ -25,3 +27,16 @@ WAGTAIL_SITE_NAME = 'Our Sites'
 WAGTAILIMAGES_IMAGE_MODEL = 'core.OurImage'
 WAGTAILIMAGES_MAX_UPLOAD_SIZE = 30 * 1024 * 1024  # 30MB
 WAGTAILDOCS_DOCUMENT_MODEL = 'our_sites.PermissionedDocument'
+
+# How document_serve sends Documents stored in S3 (see core.documents): 'proxy' streams them through gunicorn,
+# 'redirect' redirects to a presigned S3 URL, and 'accel' hands a presigned S3 URL to nginx via X-Accel-Redirect.
+DOCUMENT_SERVE_MODE = getenv('DOCUMENT_SERVE_MODE', 'proxy')
+# Overrides DOCUMENT_SERVE_MODE for specific file extensions, e.g. {'pdf': 'redirect'}.
+DOCUMENT_SERVE_MODES = {}
+DOCUMENT_PRESIGNED_URL_TIMEOUT = getenv('DOCUMENT_PRESIGNED_URL_TIMEOUT', 60)
+# The internal nginx location for 'accel' mode. It must proxy_pass to https://<the rest of the path>, with its args.
+DOCUMENT_ACCEL_REDIRECT_PREFIX = '/protected-s3/'
+
+# The networks, in CIDR notation, whose clients are "on campus" for on_campus_only Documents, e.g.
+# "['10.0.0.0/8', '2001:db8::/32']". When this is None, the Document model's own check is used instead.
+CAMPUS_NETWORKS = getenv('CAMPUS_NETWORKS', None)
@@ -5,6 +5,7 @@ from wagtail.wagtailadmin import urls as wagtailadmin_urls
 from wagtail.wagtaildocs import urls as wagtaildocs_urls
 from wagtail.wagtailcore import urls as wagtail_urls
 
+from core.views import sitemap, sitemap_section
 from wagtail_patches.views.other import login, logout
 
 urlpatterns = [
@@ -19,5 +20,9 @@ urlpatterns = [
 
     url(r'^documents/', include(wagtaildocs_urls)),
 
+    # Large Sites' sitemaps are streamed in chunks, and split into sections listed by a sitemap index.
+    url(r'^sitemap\.xml$', sitemap, name='sitemap'),
+    url(r'^sitemap-(?P<section>\d+)\.xml$', sitemap_section, name='sitemap_section'),
+
     url(r'', include(wagtail_urls))
 ]
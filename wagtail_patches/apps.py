@@ -15,6 +15,8 @@ class WagtailPatchesConfig(AppConfig):
         if not self.ready_is_done:
             # noinspection PyUnresolvedReferences
             from . import monkey_patches
+            from .signals import connect_signals
+            connect_signals()
             self.ready_is_done = True
         else:
             print("{}.ready() executed more than once! This method's code is skipped on subsequent runs.".format(
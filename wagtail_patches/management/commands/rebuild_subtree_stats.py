@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from wagtail_patches.subtree_stats import rebuild_all_subtree_stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the PageSubtreeStats table from scratch.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_all_subtree_stats()
+        self.stdout.write('Rebuilt the subtree stats of {} pages.'.format(count))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wagtailcore', '0040_page_draft_title'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageSubtreeStats',
+            fields=[
+                ('page', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='subtree_stats', serialize=False, to='wagtailcore.Page')),
+                ('descendant_count', models.PositiveIntegerField(default=0, help_text='Includes the page itself.')),
+                ('live_descendant_count', models.PositiveIntegerField(default=0, help_text='Includes the page itself.')),
+                ('owner_count', models.PositiveIntegerField(default=0, help_text='The number of distinct owners in the subtree, with "no owner" counted as an owner.')),
+                ('sole_owner', models.ForeignKey(blank=True, help_text='The owner of every page in the subtree, if there is exactly one.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'page subtree stats',
+            },
+        ),
+    ]
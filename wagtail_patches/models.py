@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.db import models
+
+
+class PageSubtreeStats(models.Model):
+    """
+    Denormalized facts about a Page's subtree (the Page and all its descendants), so that checks like
+    PagePermissionTester.can_delete() can read one row instead of scanning the subtree. See
+    wagtail_patches.subtree_stats for how these rows are kept up to date, and the rebuild_subtree_stats management
+    command for rebuilding them.
+    """
+    page = models.OneToOneField(
+        'wagtailcore.Page', on_delete=models.CASCADE, primary_key=True, related_name='subtree_stats'
+    )
+    descendant_count = models.PositiveIntegerField(default=0, help_text='Includes the page itself.')
+    live_descendant_count = models.PositiveIntegerField(default=0, help_text='Includes the page itself.')
+    owner_count = models.PositiveIntegerField(
+        default=0, help_text='The number of distinct owners in the subtree, with "no owner" counted as an owner.'
+    )
+    sole_owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='+',
+        help_text='The owner of every page in the subtree, if there is exactly one.'
+    )
+
+    class Meta:
+        verbose_name_plural = 'page subtree stats'
+
+    def __str__(self):
+        return 'Subtree stats for page {}'.format(self.page_id)
+
+    def get_flags(self, user):
+        """
+        Returns the facts about this subtree that core.permissions.SUBTREE_FLAGS describes, for the given User.
+        """
+        has_live = self.live_descendant_count > 0
+        has_unowned = not (self.owner_count == 1 and self.sole_owner_id is not None and self.sole_owner_id == user.pk)
+        return {'has_live': has_live, 'has_unowned': has_unowned, 'has_live_or_unowned': has_live or has_unowned}
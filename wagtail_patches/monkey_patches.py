@@ -30,7 +30,7 @@ from django.core.exceptions import ValidationError, PermissionDenied
 from django.db import transaction, router, connections
 from django.db.models import Count, Q
 from django.forms import modelform_factory
-from django.http import BadHeaderError, Http404, StreamingHttpResponse
+from django.http import Http404
 from django.http.response import HttpResponseForbidden, JsonResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
@@ -44,6 +44,7 @@ from logging import INFO, WARNING, ERROR, CRITICAL
 from six.moves.urllib.parse import quote
 from types import MethodType
 from wagtail.contrib.settings.forms import SiteSwitchForm
+from wagtail.contrib.settings.models import BaseSetting
 from wagtail.contrib.settings.permissions import user_can_edit_setting_type
 from wagtail.contrib.settings.views import get_model_from_url_params, get_setting_edit_handler
 from wagtail.utils import sendfile_streaming_backend
@@ -69,12 +70,19 @@ from wagtail.wagtailimages.permissions import permission_policy as image_permiss
 from wagtail.wagtailimages.views.images import permission_checker
 from wagtail.wagtailimages.views.multiple import get_image_edit_form
 from wagtail.wagtailusers.forms import BaseGroupPagePermissionFormSet
-from wsgiref.util import FileWrapper
-from unidecode import unidecode
 
+from core.cache_tags import tag_request, settings_tag
+from core.campus import request_is_on_campus
+from core.documents import serve_document_file, get_serve_mode, get_cached_document
+from core.permissions import get_page_permission_index, invalidate_page_permission_indexes, subtree_has
+from core.sitemap import invalidate_sitemaps_for_paths
 from core.logging import logger, log_new_model, request_context_logging_processor
+from core.menus import forget_menu_trees_for_paths
 from core.models import OurImage
 from core.models.utils import SiteSpecificTag
+from core.tasks import reindex_moved_page
+from core.tenants import get_tenant_snapshot
+from wagtail_patches.subtree_stats import refresh_ancestor_stats, refresh_subtree_stats
 
 
 ################################################################################################################
@@ -299,7 +307,7 @@ def patched_get_document_form(model):
     def clean_collection(self):
         request = get_current_request()
         if not request.user.is_superuser:
-            return Collection.objects.get(name=request.site.hostname)
+            return Collection.objects.get(pk=request.site.tenant.collection_id)
         return self.cleaned_data['collection']
     DocumentForm.clean_collection = clean_collection
 
@@ -339,7 +347,7 @@ def patched_get_document_multi_form(model):
     def clean_collection(self):
         request = get_current_request()
         if not request.user.is_superuser:
-            return Collection.objects.get(name=request.site.hostname)
+            return Collection.objects.get(pk=request.site.tenant.collection_id)
         return self.cleaned_data['collection']
     DocumentMultiForm.clean_collection = clean_collection
 
@@ -361,7 +369,7 @@ def patched_document_chooser(request):
         # Monkey-patch: Set the intitial value for the Collection to the current Site's collection.
         # This is REQUIRED for non-superusers because django sets the initial value to 1 by default, which will always
         # throw an error because non-superusers dont have permission on the Root collection.
-        initial = {'collection': Collection.objects.get(name=request.site.hostname)}
+        initial = {'collection': request.site.tenant.collection_id}
         uploadform = DocumentForm(user=request.user, initial=initial)
     else:
         uploadform = None
@@ -469,7 +477,7 @@ def patched_documents_index(request):
             documents = documents.filter(collection=current_collection)
     # Non-superusers always get their documwnts filtered by the current Site's Collection.
     if not request.user.is_superuser:
-        current_collection = Collection.objects.get(name=request.site.hostname)
+        current_collection = Collection.objects.get(pk=request.site.tenant.collection_id)
         documents = documents.filter(collection=current_collection)
 
     # Search
@@ -541,7 +549,7 @@ def patched_documents_multiple_add(request):
         if request.user.is_superuser:
             collection_id = request.POST.get('collection')
         else:
-            collection_id = Collection.objects.get(name=request.site.hostname).id
+            collection_id = request.site.tenant.collection_id
 
         # Build a form for validation
         form = DocumentForm({
@@ -735,7 +743,7 @@ def patched_get_image_form(model):
     def clean_collection(self):
         request = get_current_request()
         if not request.user.is_superuser:
-            return Collection.objects.get(name=request.site.hostname)
+            return Collection.objects.get(pk=request.site.tenant.collection_id)
         return self.cleaned_data['collection']
     ImageForm.clean_collection = clean_collection
 
@@ -760,7 +768,7 @@ def patched_image_chooser(request):
         # Monkey-patch: Set the intitial value for the Collection to the current Site's collection.
         # This is REQUIRED for non-superusers because django sets the initial value to 1 by default, which will always
         # throw an error because non-superusers dont have permission on the Root collection.
-        initial = {'collection': Collection.objects.get(name=request.site.hostname)}
+        initial = {'collection': request.site.tenant.collection_id}
         uploadform = ImageForm(user=request.user, initial=initial)
     else:
         uploadform = None
@@ -867,7 +875,7 @@ def patched_images_index(request):
             images = images.filter(collection=current_collection)
     # Non-superusers always get their images filtered by the current Site's Collection.
     if not request.user.is_superuser:
-        current_collection = Collection.objects.get(name=request.site.hostname)
+        current_collection = Collection.objects.get(pk=request.site.tenant.collection_id)
         images = images.filter(collection=current_collection)
 
     # Search
@@ -936,7 +944,7 @@ def patched_images_multiple_add(request):
         if request.user.is_superuser:
             collection_id = request.POST.get('collection')
         else:
-            collection_id = Collection.objects.get(name=request.site.hostname).id
+            collection_id = request.site.tenant.collection_id
 
         # Build a form for validation
         form = ImageForm({
@@ -1001,6 +1009,7 @@ def single_site_search(request):
         if form.is_valid():
             q = form.cleaned_data['q']
 
+            # core.search also limits the search to the current Site, but this keeps the database query scoped too.
             pages = Page.objects.in_site(request.site).prefetch_related('content_type').search(q)
             paginator, pages = paginate(request, pages)
     else:
@@ -1087,12 +1096,30 @@ def multitenant_settings_edit(request, app_name, model_name, site_pk):
 wagtail.contrib.settings.views.edit = multitenant_settings_edit
 
 
+################################################################################################################
+# PermissionedDocument.user_is_on_campus() gets called for every on-campus-only Document that's listed or downloaded.
+# Answer it at most once per request, using the compiled CAMPUS_NETWORKS matcher when that setting is configured (see
+# core.campus), and the model's own check otherwise.
+################################################################################################################
+permissioned_document_user_is_on_campus = get_document_model().user_is_on_campus
+
+
+def user_is_on_campus(self, request):
+    if getattr(settings, 'CAMPUS_NETWORKS', None) is None:
+        return request_is_on_campus(request, lambda request: permissioned_document_user_is_on_campus(self, request))
+    return request_is_on_campus(request)
+get_document_model().user_is_on_campus = user_is_on_campus
+
+
 ################################################################################################################
 # Monkey-patches the Document serve view to check for our custom PermissionedDocument states.
 ################################################################################################################
 def document_serve(request, document_id, document_filename):
     Document = get_document_model()
-    doc = get_object_or_404(Document, id=document_id)
+    # Loading the Document from the metadata cache saves a query, and the storage request for its size.
+    doc = get_cached_document(document_id)
+    if doc is None:
+        raise Http404('No Document matches the given query.')
 
     if doc.on_campus_only and not doc.user_is_on_campus(request):
         return HttpResponseForbidden("<h1>User must be on campus to view this document.</h1>")
@@ -1133,22 +1160,13 @@ def document_serve(request, document_id, document_filename):
     else:
         # We are using a storage backend which does not expose filesystem paths
         # (e.g. storages.backends.s3boto.S3BotoStorage).
-        # Fall back on pre-sendfile behaviour of reading the file content and serving it
-        # as a StreamingHttpResponse.
-        wrapper = FileWrapper(doc.file)
-        response = StreamingHttpResponse(wrapper, content_type='application/octet-stream')
-
-        try:
-            response['Content-Disposition'] = 'attachment; filename=%s' % doc.filename
-        except BadHeaderError:
-            # Unicode filenames can fail on Django <1.8, Python 2 due to
-            # https://code.djangoproject.com/ticket/20889 - try with an ASCIIfied version of the name
-            response['Content-Disposition'] = 'attachment; filename=%s' % unidecode(doc.filename)
-
-        # FIXME: storage backends are not guaranteed to implement 'size'
-        response['Content-Length'] = doc.file.size
-
-        return response
+        # Depending on the document's type, either stream it with support for conditional and Range requests, or hand
+        # the download off to S3 or nginx so it doesn't tie up this worker (see core.documents).
+        metadata = doc.document_metadata
+        return serve_document_file(
+            request, doc.file, doc.filename, mode=get_serve_mode(doc.filename), content_type=metadata.content_type,
+            metadata=metadata.file
+        )
 
 wagtail.wagtaildocs.views.serve.serve = document_serve
 
@@ -1177,6 +1195,16 @@ def de_namespaced_username(self):
 django.contrib.auth.models.User.de_namespaced_username = de_namespaced_username
 
 
+#################################################################################################################
+# Add a "tenant" property to Site which returns its TenantSnapshot. This lets code that has a Site in hand read its
+# Collection id, Group ids, aliases, etc. without re-deriving them from the hostname with a query each time.
+#################################################################################################################
+def site_tenant(self):
+    return get_tenant_snapshot(self)
+
+Site.tenant = property(site_tenant)
+
+
 #################################################################################################################
 # Patch the wagtail.wagtailadmin.views.home.RecentEditsPanel.__init__ constructor to filter based on current site.
 # This prevent users permissioned on multiple sites from seeing pages not belonging to the site they are
@@ -1185,29 +1213,30 @@ django.contrib.auth.models.User.de_namespaced_username = de_namespaced_username
 def RecentEditsInit(self, request):
     self.request = request
 
-    site_pages = Page.objects.in_site(request.site)
-    site_keys = [p.pk for p in site_pages]
-
-    # Last n edited pages
+    # Last n edited pages in the current site. The site filter is applied inside the subquery, as a prefix match on the
+    # pages' treebeard paths (just like Page.objects.in_site()), so the LIMIT counts only this site's pages and we
+    # never need to load the site's entire page list. The outer join matches on page_id as well as created_at, so that
+    # a revision of some other page which happens to share a timestamp can't sneak in.
     last_edits = PageRevision.objects.raw(
         """
         SELECT wp.* FROM
             wagtailcore_pagerevision wp JOIN (
-                SELECT max(created_at) AS max_created_at, page_id FROM
-                    wagtailcore_pagerevision WHERE user_id = %s GROUP BY page_id ORDER BY max_created_at DESC LIMIT %s
-            ) AS max_rev ON max_rev.max_created_at = wp.created_at ORDER BY wp.created_at DESC
+                SELECT max(rev.created_at) AS max_created_at, rev.page_id FROM
+                    wagtailcore_pagerevision rev JOIN wagtailcore_page page ON page.id = rev.page_id
+                WHERE rev.user_id = %s AND page.path LIKE %s
+                GROUP BY rev.page_id ORDER BY max_created_at DESC LIMIT %s
+            ) AS max_rev ON max_rev.max_created_at = wp.created_at AND max_rev.page_id = wp.page_id
+        ORDER BY wp.created_at DESC
          """, [
             get_user_model()._meta.pk.get_db_prep_value(self.request.user.pk, connections['default']),
+            request.site.root_page.path + '%',
             getattr(settings, 'WAGTAILADMIN_RECENT_EDITS_LIMIT', 5)
         ]
     )
     last_edits = list(last_edits)
-    last_edits = [edit for edit in last_edits if edit.page.pk in site_keys]
-    page_keys = [pr.page.pk for pr in last_edits]
-    specific_pages = site_pages.filter(pk__in=page_keys)
-    pages = {p.pk: p for p in specific_pages}
+    pages = Page.objects.in_bulk([edit.page_id for edit in last_edits])
     self.last_edits = [
-        [review, pages.get(review.page.pk)] for review in last_edits
+        [review, pages.get(review.page_id)] for review in last_edits
     ]
 
 wagtail.wagtailadmin.views.home.RecentEditsPanel.__init__ = RecentEditsInit
@@ -1223,10 +1252,9 @@ def get_explorer_pages(user):
         # superuser has implicit permission on the root node
         return Page.objects.filter(depth=1)
     else:
-        return Page.objects.in_site(get_current_request().site).filter(
-            group_permissions__group__in=user.groups.all(),
-            group_permissions__permission_type__in=['add', 'edit', 'publish', 'lock']
-        )
+        # The user's permission index (see core.permissions) already knows which pages those are.
+        paths = get_page_permission_index(user).get_paths_with(['add', 'edit', 'publish', 'lock'])
+        return Page.objects.in_site(get_current_request().site).filter(path__in=paths)
 
 wagtail.wagtailadmin.navigation.get_pages_with_direct_explore_permission = get_explorer_pages
 
@@ -1307,6 +1335,51 @@ def patched_users_with_page_permission(page, permission_type, include_superusers
 wagtail.wagtailadmin.utils.users_with_page_permission = patched_users_with_page_permission
 
 
+#################################################################################################################
+# Patch PagePermissionTester.__init__ to read the user's permissions on the page from their permission index (see
+# core.permissions), rather than from a UserPagePermissionsProxy's GroupPagePermission query.
+# Page.permissions_for_user() makes a new proxy for every page, so this was one query per page in explorer listings.
+# Patched from commit: 7175cd8d9b958e324176d3c3f072567b49591873 (Version bump to 1.12.2)
+#################################################################################################################
+def patched_permission_tester_init(self, user_perms, page):
+    self.user = user_perms.user
+    self.user_perms = user_perms
+    self.page = page
+    self.page_is_root = page.depth == 1  # Equivalent to page.is_root()
+
+    if self.user.is_active and not self.user.is_superuser:
+        self.permissions = get_page_permission_index(self.user).get_permissions(self.page.path)
+PagePermissionTester.__init__ = patched_permission_tester_init
+
+
+#################################################################################################################
+# Moving a page changes its path, and those of its descendants, so any permission index entries for them are stale.
+# It also moves the page's subtree out from under its old ancestors and into its new ones, so both sets of ancestors'
+# PageSubtreeStats need recomputing. And if the page changes tenants, so do its subtree's search documents. The menu
+# trees of the Sites it was moved out of and into hold the subtree's old paths, so they're thrown away, and so are the
+# Sites' sitemaps.
+#################################################################################################################
+wagtail_page_move = Page.move
+
+
+def move(self, target, pos=None):
+    # The old ancestors' paths may change during the move, so remember them by pk.
+    old_ancestor_pks = list(self.get_ancestors().filter(depth__gt=1).values_list('pk', flat=True))
+    old_path = self.path
+    wagtail_page_move(self, target, pos=pos)
+    invalidate_page_permission_indexes()
+
+    def refresh_moved_subtree():
+        moved = Page.objects.get(pk=self.pk)
+        refresh_ancestor_stats(moved.path, inclusive=False)
+        refresh_subtree_stats(Page.objects.filter(pk__in=old_ancestor_pks).only('pk', 'path'))
+        forget_menu_trees_for_paths(old_path, moved.path)
+        invalidate_sitemaps_for_paths(old_path, moved.path)
+    transaction.on_commit(refresh_moved_subtree)
+    transaction.on_commit(lambda: reindex_moved_page.apply_async(args=[self.pk, old_path]))
+Page.move = move
+
+
 #################################################################################################################
 # Patch the wagtail.wagtailcore.models.PermissionTester class to prevent the bulk_delete permission from
 # affecting move operations. It breaks the ability to move subtrees around in the Sitemap.
@@ -1333,27 +1406,41 @@ def patched_can_delete(self, ignore_bulk=False):
     if 'bulk_delete' not in self.permissions and not self.page.is_leaf() and not ignore_bulk:
         return False
 
+    # The subtree checks below are answered from prefetch_subtree_flags() when a listing has called it for all its
+    # pages at once (see core.permissions), and with a query otherwise.
     if 'edit' in self.permissions:
         # if the user does not have publish permission, we also need to confirm that there
         # are no published pages here
         if 'publish' not in self.permissions:
-            pages_to_delete = self.page.get_descendants(inclusive=True)
-            if pages_to_delete.live().exists():
+            if subtree_has(self.page, self.user, 'has_live'):
                 return False
 
         return True
 
     elif 'add' in self.permissions:
-        pages_to_delete = self.page.get_descendants(inclusive=True)
         if 'publish' in self.permissions:
             # we don't care about live state, but all pages must be owned by this user
             # (i.e. eliminating pages owned by this user must give us the empty set)
-            return not pages_to_delete.exclude(owner=self.user).exists()
+            return not subtree_has(self.page, self.user, 'has_unowned')
         else:
             # all pages must be owned by this user and non-live
             # (i.e. eliminating non-live pages owned by this user must give us the empty set)
-            return not pages_to_delete.exclude(live=False, owner=self.user).exists()
+            return not subtree_has(self.page, self.user, 'has_live_or_unowned')
 
     else:
         return False
 PagePermissionTester.can_delete = patched_can_delete
+
+
+#################################################################################################################
+# Tag the current request with each settings model it reads, so that cached responses which show a Site's settings
+# are evicted when those settings are saved (see core.cache_tags).
+#################################################################################################################
+original_for_site = BaseSetting.for_site.__func__
+
+
+def for_site(cls, site):
+    tag_request(settings_tag(cls, site.pk))
+    return original_for_site(cls, site)
+
+BaseSetting.for_site = classmethod(for_site)
@@ -0,0 +1,61 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from wagtail.wagtailcore.models import Page
+
+from wagtail_patches.subtree_stats import refresh_ancestor_stats, adjust_live_counts
+
+
+# noinspection PyUnusedLocal
+def remember_subtree_fields(sender, instance, update_fields=None, **kwargs):
+    """
+    Records the live and owner values that a Page had before this save, so that update_subtree_stats_for_saved_page()
+    can tell what changed. Saves which can't change either of them are skipped, to save the query.
+    """
+    if not isinstance(instance, Page) or instance.pk is None:
+        return
+    if update_fields is not None and not {'live', 'owner'} & set(update_fields):
+        return
+    instance._old_subtree_fields = Page.objects.filter(pk=instance.pk).values_list('live', 'owner_id').first()
+
+
+# noinspection PyUnusedLocal
+def update_subtree_stats_for_saved_page(sender, instance, created, **kwargs):
+    """
+    Updates the PageSubtreeStats of a Page which was just saved, and of its ancestors. Page subclasses send post_save
+    with themselves as the sender, so we can't filter by sender when connecting this.
+    """
+    if not isinstance(instance, Page) or instance.depth <= 1:
+        return
+    old_fields = instance.__dict__.pop('_old_subtree_fields', None)
+    if created or old_fields is None:
+        if created:
+            transaction.on_commit(lambda: refresh_ancestor_stats(instance.path))
+        return
+
+    old_live, old_owner_id = old_fields
+    if old_owner_id != instance.owner_id:
+        transaction.on_commit(lambda: refresh_ancestor_stats(instance.path))
+    elif old_live != instance.live:
+        adjust_live_counts(instance.path, 1 if instance.live else -1)
+
+
+# noinspection PyUnusedLocal
+def update_subtree_stats_for_deleted_page(sender, instance, **kwargs):
+    """
+    Deleting a Page deletes its descendants in the same query, and only then sends post_delete for each of them. So
+    only the topmost deleted Page, whose parent still exists, needs its ancestors' stats recomputed.
+    """
+    if not isinstance(instance, Page) or instance.depth <= 2:
+        return
+    parent_path = instance.path[:-Page.steplen]
+    if Page.objects.filter(path=parent_path).exists():
+        transaction.on_commit(lambda: refresh_ancestor_stats(parent_path))
+
+
+def connect_signals():
+    """
+    Connects all of wagtail_patches's signal handlers. Called from WagtailPatchesConfig.ready().
+    """
+    pre_save.connect(remember_subtree_fields, dispatch_uid='subtree_stats_page_pre_save')
+    post_save.connect(update_subtree_stats_for_saved_page, dispatch_uid='subtree_stats_page_saved')
+    post_delete.connect(update_subtree_stats_for_deleted_page, dispatch_uid='subtree_stats_page_deleted')
@@ -0,0 +1,118 @@
+"""
+Keeps the PageSubtreeStats table up to date.
+
+Publishing and unpublishing only change live counts, so those are adjusted in place with a single UPDATE of the Page's
+ancestors' rows (plus a recompute of any row whose count has drifted too low to be decremented). Anything that can
+change a subtree's size or owners (creating, deleting, or moving a Page, or changing its owner) recomputes the rows of
+the affected ancestors instead, one aggregate query each.
+"""
+from django.db.models import Count, Case, When, Min, Max, F, IntegerField
+from wagtail.wagtailcore.models import Page
+
+from wagtail_patches.models import PageSubtreeStats
+
+
+def get_ancestor_paths(path, inclusive=True):
+    """
+    Returns the paths of the Page at the given path and its ancestors, excluding the ultimate root Page, whose subtree
+    is every Page there is (and which can never be deleted or moved anyway).
+    """
+    end = len(path) + (Page.steplen if inclusive else 0)
+    return [path[:length] for length in range(2 * Page.steplen, end, Page.steplen)]
+
+
+def compute_subtree_stats(page):
+    """
+    Returns the field values of the given Page's PageSubtreeStats, computed from its subtree with one query.
+    """
+    stats = Page.objects.filter(path__startswith=page.path).aggregate(
+        descendant_count=Count('pk'),
+        live_descendant_count=Count(Case(When(live=True, then=1), output_field=IntegerField())),
+        distinct_owners=Count('owner', distinct=True),
+        unowned=Max(Case(When(owner__isnull=True, then=1), default=0, output_field=IntegerField())),
+        min_owner=Min('owner'),
+    )
+    owner_count = stats['distinct_owners'] + (1 if stats['unowned'] else 0)
+    return {
+        'descendant_count': stats['descendant_count'],
+        'live_descendant_count': stats['live_descendant_count'],
+        'owner_count': owner_count,
+        'sole_owner_id': stats['min_owner'] if owner_count == 1 else None,
+    }
+
+
+def refresh_subtree_stats(pages):
+    """
+    Recomputes the PageSubtreeStats of each of the given Pages.
+    """
+    for page in pages:
+        PageSubtreeStats.objects.update_or_create(page_id=page.pk, defaults=compute_subtree_stats(page))
+
+
+def refresh_ancestor_stats(path, inclusive=True):
+    """
+    Recomputes the PageSubtreeStats of the Page at the given path (unless inclusive is False), and of its ancestors.
+    """
+    refresh_subtree_stats(Page.objects.filter(path__in=get_ancestor_paths(path, inclusive)).only('pk', 'path'))
+
+
+def adjust_live_counts(path, delta):
+    """
+    Adds delta to the live descendant counts of the Page at the given path and of its ancestors, with one query. A
+    count which is too low to take a negative delta has drifted from the truth (and subtracting from it would be an
+    out of range error on MySQL's unsigned columns), so those rows are recomputed instead.
+    """
+    stats = PageSubtreeStats.objects.filter(page__path__in=get_ancestor_paths(path))
+    drifted_pks = []
+    if delta < 0:
+        drifted_pks = list(stats.filter(live_descendant_count__lt=-delta).values_list('page_id', flat=True))
+        stats = stats.exclude(page_id__in=drifted_pks)
+    stats.update(live_descendant_count=F('live_descendant_count') + delta)
+    if drifted_pks:
+        refresh_subtree_stats(Page.objects.filter(pk__in=drifted_pks).only('pk', 'path'))
+
+
+def make_stats(page_pk, descendant_count, live_descendant_count, owners):
+    return PageSubtreeStats(
+        page_id=page_pk,
+        descendant_count=descendant_count,
+        live_descendant_count=live_descendant_count,
+        owner_count=len(owners),
+        # None in owners stands for pages with no owner, so a sole owner of None means there's no sole owner.
+        sole_owner_id=next(iter(owners)) if len(owners) == 1 else None,
+    )
+
+
+def rebuild_all_subtree_stats(batch_size=1000):
+    """
+    Recomputes every Page's PageSubtreeStats from scratch, and returns how many there are. This reads every Page once,
+    in path order, keeping running totals for the current Page's ancestors on a stack.
+    """
+    pages = Page.objects.filter(depth__gt=1).order_by('path').values_list('pk', 'path', 'live', 'owner_id')
+    # Each stack entry is [pk, path, descendant_count, live_descendant_count, owners].
+    stack = []
+    batch = []
+    count = 0
+
+    def pop():
+        pk, _, descendant_count, live_descendant_count, owners = stack.pop()
+        if stack:
+            parent = stack[-1]
+            parent[2] += descendant_count
+            parent[3] += live_descendant_count
+            parent[4].update(owners)
+        batch.append(make_stats(pk, descendant_count, live_descendant_count, owners))
+
+    PageSubtreeStats.objects.all().delete()
+    for pk, path, live, owner_id in pages.iterator():
+        while stack and not path.startswith(stack[-1][1]):
+            pop()
+        stack.append([pk, path, 1, 1 if live else 0, {owner_id}])
+        count += 1
+        if len(batch) >= batch_size:
+            PageSubtreeStats.objects.bulk_create(batch)
+            batch = []
+    while stack:
+        pop()
+    PageSubtreeStats.objects.bulk_create(batch)
+    return count
@@ -1,6 +1,10 @@
 from django import template
 from django.utils.html import format_html
 from wagtail.wagtailadmin.navigation import get_pages_with_direct_explore_permission
+from wagtail.wagtailcore.models import Page
+
+from core.cache_tags import tag_request, page_tag, snippet_tag
+from core.permissions import prefetch_subtree_flags
 
 register = template.Library()
 
@@ -41,11 +45,49 @@ def site_specific_group_name(group, request):
         return group.name.replace(request.site.hostname, '').strip()
 
 
+def get_explorable_page_paths(request):
+    """
+    Returns the treebeard paths of the pages that the request's user has direct explore permission on. They're looked
+    up once per request, and memoized on it.
+    """
+    try:
+        return request._explorable_page_paths
+    except AttributeError:
+        pages = get_pages_with_direct_explore_permission(request.user)
+        request._explorable_page_paths = tuple(pages.values_list('path', flat=True))
+        return request._explorable_page_paths
+
+
 @register.simple_tag(takes_context=True)
 def page_explorable(context, page):
     """
-    Tests whether a given user has permission for a page.
+    Tests whether a given user has permission for a page, i.e. whether the page is one the user has direct explore
+    permission on, or a descendant of one. This is a prefix check against the page's path, so listing many pages
+    costs a single query.
+    """
+    return page.path.startswith(get_explorable_page_paths(context['request']))
+
+
+@register.simple_tag(takes_context=True)
+def cache_tags(context, *objects):
+    """
+    Records that the page being rendered shows the given Pages and snippets, so that saving any of them will evict the
+    cached copies of this page (see core.cache_tags). Renders nothing.
+    """
+    tag_request(
+        *[page_tag(obj.pk) if isinstance(obj, Page) else snippet_tag(obj) for obj in objects if obj is not None],
+        request=context.get('request')
+    )
+    return ''
+
+
+@register.simple_tag(takes_context=True)
+def prefetch_delete_permissions(context, pages):
+    """
+    Lets the page_permissions tag answer can_delete and can_move for every page in a listing without running subtree
+    queries for each one. Renders nothing.
     """
     user = context['request'].user
-    pages = get_pages_with_direct_explore_permission(user)
-    return page in pages
+    if user.is_active and not user.is_superuser:
+        prefetch_subtree_flags(pages, user)
+    return ''
@@ -0,0 +1,81 @@
+from django.test import TestCase
+from mock import patch
+from wagtail.wagtailcore.models import Page
+
+from core.tests.transactions import run_on_commit_callbacks
+from core.tests.utils import MultitenantSiteTestingMixin
+from wagtail_patches.models import PageSubtreeStats
+from wagtail_patches.subtree_stats import compute_subtree_stats, rebuild_all_subtree_stats
+
+
+class PageSubtreeStatsTest(TestCase, MultitenantSiteTestingMixin):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.set_up_test_sites_and_users()
+
+    def setUp(self):
+        rebuild_all_subtree_stats()
+        self.home = self.wagtail_site.root_page
+
+    def assert_stats_are_correct(self, *pages):
+        for page in pages:
+            page = Page.objects.get(pk=page.pk)
+            stats = PageSubtreeStats.objects.get(page=page)
+            self.assertEqual(
+                {field: getattr(stats, field) for field in compute_subtree_stats(page)}, compute_subtree_stats(page),
+                'Wrong stats for {}'.format(page)
+            )
+
+    def add_page(self, parent, slug, **kwargs):
+        with run_on_commit_callbacks():
+            return parent.add_child(instance=Page(title=slug, slug=slug, owner=self.superuser, **kwargs))
+
+    def test_subtree_stats_flags_depend_on_the_sole_owner(self):
+        stats = PageSubtreeStats(live_descendant_count=0, owner_count=1, sole_owner_id=self.superuser.pk)
+        self.assertEqual(
+            stats.get_flags(self.superuser), {'has_live': False, 'has_unowned': False, 'has_live_or_unowned': False}
+        )
+        stats.owner_count = 2
+        stats.sole_owner_id = None
+        self.assertTrue(stats.get_flags(self.superuser)['has_unowned'])
+
+    def test_rebuild_matches_the_computed_stats(self):
+        parent = self.add_page(self.home, 'parent')
+        self.add_page(parent, 'child', live=False)
+        self.assertEqual(rebuild_all_subtree_stats(), Page.objects.filter(depth__gt=1).count())
+        self.assert_stats_are_correct(*Page.objects.filter(depth__gt=1))
+
+    def test_stats_are_maintained_as_pages_change(self):
+        parent = self.add_page(self.home, 'parent')
+        child = self.add_page(parent, 'child')
+        self.assert_stats_are_correct(self.home, parent, child)
+
+        with run_on_commit_callbacks():
+            child.unpublish()
+        self.assert_stats_are_correct(self.home, parent, child)
+
+        with run_on_commit_callbacks():
+            child.save_revision().publish()
+        self.assert_stats_are_correct(self.home, parent, child)
+
+        with run_on_commit_callbacks():
+            child.owner = self.wagtail_admin
+            child.save()
+        self.assert_stats_are_correct(self.home, parent, child)
+
+        # Moving a page reindexes it in a celery task, which there's no need for here.
+        with patch('wagtail_patches.monkey_patches.reindex_moved_page'), run_on_commit_callbacks():
+            Page.objects.get(pk=child.pk).move(self.home, pos='last-child')
+        self.assert_stats_are_correct(self.home, parent, child)
+
+        with run_on_commit_callbacks():
+            Page.objects.get(pk=child.pk).delete()
+        self.assert_stats_are_correct(self.home, parent)
+
+    def test_unpublishing_recomputes_live_counts_that_have_drifted(self):
+        child = self.add_page(self.home, 'child')
+        PageSubtreeStats.objects.filter(page=self.home).update(live_descendant_count=0)
+        with run_on_commit_callbacks():
+            child.unpublish()
+        self.assert_stats_are_correct(self.home, child)
@@ -1,10 +1,22 @@
 from __future__ import absolute_import, unicode_literals
 
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
 from django.urls import reverse
-from django.http.response import HttpResponseRedirect
-from django.test import TestCase
+from django.http.response import HttpResponse, HttpResponseRedirect
+from django.middleware.csrf import CsrfViewMiddleware, get_token
+from django.test import TestCase, RequestFactory, override_settings
+from wagtail.wagtailcore.models import Collection
 
+from core.cache_tags import get_request_tags, page_tag, site_tag, tag_request
+from core.middleware import AnonymousPageCacheMiddleware
+from core.page_cache import get_cached_response, get_page_cache_key, get_site_page_cache_version_key
+from core.routing import site_routing_table, unknown_host_cache
+from core.tenants import tenant_snapshots
+from core.tests.transactions import run_on_commit_callbacks
 from core.tests.utils import SecureClientMixin, MultitenantSiteTestingMixin
+from core.utils import bump_cache_version, get_user_site_membership_version_key, SITE_MEMBERSHIP_VERSION_KEY
 from our_sites.models.settings import Alias
 
 
@@ -44,3 +56,116 @@ class MiddlewareTest(SecureClientMixin, TestCase, MultitenantSiteTestingMixin):
         response = self.client.get(reverse('wagtailadmin_logout'), HTTP_HOST=self.wagtail_site.hostname)
         self.assertTrue(isinstance(response, HttpResponseRedirect))
         self.assertEqual(response.url, 'http://{}'.format(alias))
+
+    def test_routing_table_picks_up_new_alias(self):
+        # Build the routing table before the alias exists, to prove that saving the alias invalidates it.
+        site_routing_table.match(self.wagtail_site.hostname)
+        alias = 'routed.oursites.com'
+        self.wagtail_site.settings.aliases.add(Alias(domain=alias))
+        self.wagtail_site.settings.save()
+        match_type, site = site_routing_table.match(alias)
+        self.assertEqual(match_type, 'alias')
+        self.assertEqual(site.pk, self.wagtail_site.pk)
+
+    def test_routing_table_matches_hostnames_case_insensitively(self):
+        match_type, site = site_routing_table.match(self.wagtail_site.hostname.upper())
+        self.assertEqual(match_type, 'hostname')
+        self.assertEqual(site.pk, self.wagtail_site.pk)
+
+    def test_unknown_hostname_gets_404(self):
+        response = self.client.get('/', HTTP_HOST='nonexistent.oursites.com')
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_hostname_is_remembered_until_a_site_claims_it(self):
+        hostname = 'scanner.oursites.com'
+        unknown_host_cache.clear()
+        self.client.get('/', HTTP_HOST=hostname)
+        hits = unknown_host_cache.hits
+        response = self.client.get('/', HTTP_HOST=hostname)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(unknown_host_cache.hits, hits + 1)
+
+        self.wagtail_site.settings.aliases.add(Alias(domain=hostname))
+        self.wagtail_site.settings.save()
+        self.assertFalse(unknown_host_cache.is_unknown(hostname, site_routing_table.get_routes().version))
+
+    def test_removing_user_from_site_groups_logs_them_out_of_that_site(self):
+        self.login(self.wagtail_admin.username)
+        self.client.get(reverse('wagtailadmin_home'), HTTP_HOST=self.wagtail_site.hostname)
+        # The membership verdict is now memoized in the session, so this proves that changing the Groups invalidates it.
+        with run_on_commit_callbacks():
+            self.wagtail_admin.groups.clear()
+        self.client.get(reverse('wagtailadmin_home'), HTTP_HOST=self.wagtail_site.hostname)
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+    def test_membership_verdicts_survive_evicted_version_counters(self):
+        self.login(self.wagtail_admin.username)
+        self.client.get(reverse('wagtailadmin_home'), HTTP_HOST=self.wagtail_site.hostname)
+        self.wagtail_admin.groups.clear()
+        # If the counters are evicted, they must not come back as the versions the session's verdict was stored under.
+        cache.delete_many([SITE_MEMBERSHIP_VERSION_KEY, get_user_site_membership_version_key(self.wagtail_admin.pk)])
+        self.client.get(reverse('wagtailadmin_home'), HTTP_HOST=self.wagtail_site.hostname)
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+    def test_tenant_snapshot_matches_site_and_tracks_alias_changes(self):
+        tenant = tenant_snapshots.get(self.wagtail_site)
+        self.assertEqual(tenant.collection_id, Collection.objects.get(name=self.wagtail_site.hostname).pk)
+        self.assertEqual(tenant.root_page_id, self.wagtail_site.root_page_id)
+        self.assertEqual(tenant.alias_domains, ())
+
+        self.wagtail_site.settings.aliases.add(Alias(domain='snapshot.oursites.com'))
+        self.wagtail_site.settings.save()
+        self.assertEqual(tenant_snapshots.get(self.wagtail_site).alias_domains, ('snapshot.oursites.com',))
+
+    def test_page_cache_key_ignores_tracking_params_and_param_order(self):
+        factory = RequestFactory()
+        request = factory.get('/news/?b=2&utm_source=email&a=1')
+        request.site = self.wagtail_site
+        other = factory.get('/news/?a=1&b=2')
+        other.site = self.wagtail_site
+        self.assertEqual(get_page_cache_key(request), get_page_cache_key(other))
+        other = factory.get('/news/?a=1&b=3')
+        other.site = self.wagtail_site
+        self.assertNotEqual(get_page_cache_key(request), get_page_cache_key(other))
+        other = factory.get('/news/?a=1&b=2', secure=True)
+        other.site = self.wagtail_site
+        self.assertNotEqual(get_page_cache_key(request), get_page_cache_key(other))
+
+    @override_settings(PAGE_CACHE_ENABLED=True)
+    def test_page_cache_middleware_never_stores_responses_that_will_get_cookies(self):
+        def view(request):
+            if 'csrf' in request.GET:
+                return HttpResponse(get_token(request))
+            if 'session' in request.GET:
+                request.session.get('anything')
+            return HttpResponse('page')
+
+        def get(path):
+            request = RequestFactory().get(path)
+            request.site = self.wagtail_site
+            # These middleware are in the same order as in settings.MIDDLEWARE, so the cookies are added last.
+            return request, SessionMiddleware(CsrfViewMiddleware(AnonymousPageCacheMiddleware(view)))(request)
+
+        # Start from an empty page cache, whatever earlier test runs left in redis.
+        bump_cache_version(get_site_page_cache_version_key(self.wagtail_site.pk))
+        self.assertEqual(get('/page/')[1]['X-Page-Cache'], 'MISS')
+        self.assertEqual(get('/page/')[1]['X-Page-Cache'], 'HIT')
+
+        request, response = get('/page/?csrf=1')
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+        self.assertNotIn('X-Page-Cache', response)
+        self.assertIsNone(get_cached_response(request))
+
+        # A page which merely reads the empty session is the same for every anonymous visitor, but has to say so.
+        request, response = get('/page/?session=1')
+        self.assertEqual(response['X-Page-Cache'], 'MISS')
+        self.assertIn('Cookie', get_cached_response(request)['Vary'])
+
+    def test_request_cache_tags_include_site_view_and_tagged_objects(self):
+        request = RequestFactory().get('/')
+        request.site = self.wagtail_site
+        request.view_data = {'app_name': 'wagtailcore', 'view_name': 'serve'}
+        tag_request(page_tag(self.wagtail_site.root_page_id), request=request)
+        self.assertEqual(get_request_tags(request), {
+            site_tag(self.wagtail_site.pk), page_tag(self.wagtail_site.root_page_id), 'view-wagtailcore-serve'
+        })
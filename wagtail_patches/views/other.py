@@ -79,21 +79,16 @@ def logout(request):
     # won't override the above and write a new cookie.
     request.session.modified = False
 
-    # Just in case something is messed up with the Site's settings, avoid a crash.
-    try:
-        alias_count = request.site.settings.aliases.count()
-    except:
-        alias_count = 0
+    alias_domains = request.site.tenant.alias_domains
 
     # If we can get the referer, we use it as long as it's not an admin page (which would redirect back to the
     # login prompt). The user's already there, so we know it won't give a cert error.
     referer = request.META.get('HTTP_REFERER')
     if referer and '/admin/' not in referer:
         redirect_url = referer
-    elif alias_count == 1:
+    elif len(alias_domains) == 1:
         # If there is exactly one alias, redirect to the homepage of that domain.
-        alias = request.site.settings.aliases.first()
-        redirect_url = 'http://{}'.format(alias.domain)
+        redirect_url = 'http://{}'.format(alias_domains[0])
     else:
         # We can't know which to pick among multiple aliases, so we fall back on the homepage of the canonical hostname.
         redirect_url = 'http://{}'.format(request.site.hostname)
@@ -3,6 +3,8 @@ from django.contrib.staticfiles.templatetags.staticfiles import static
 from django.utils.html import format_html
 from wagtail.wagtailcore import hooks
 
+from core.cache_tags import tag_request, page_tag
+
 from .urls import users, groups
 
 
@@ -24,3 +26,11 @@ def global_admin_css():
     Add some custom CSS for our patched/replaced forms.
     """
     return format_html('<link rel="stylesheet" href="{}">', static('wagtail_patches/css/admin.css'))
+
+
+@hooks.register('before_serve_page')
+def tag_served_page(page, request, serve_args, serve_kwargs):
+    """
+    Tags the response with the Page being served, so that publishing the Page evicts its cached copies.
+    """
+    tag_request(page_tag(page.pk), request=request)